@@ -0,0 +1,567 @@
+"""
+Offline latency benchmarks for the Flask endpoints.
+
+TVmaze, TheTVDB and Slack are replaced by local HTTP stand-ins that replay the
+payloads in benchmark_payloads.json (or a file of recorded responses passed with
+--payloads), with configurable latency and injected 429s. Requests are driven
+through Flask's test client and the results are written as JSON so runs can be
+compared with --compare.
+
+Needs a scratch Postgres database; the schema is migrated and a benchmark user
+is created in it:
+
+    DATABASE_URL=postgresql://localhost/jarvis_bench python benchmark.py \\
+        --requests 200 --concurrency 8 --latency-ms 40 --error-rate 0.02 --output bench.json
+
+To measure an older commit, copy this file into a worktree checked out at that
+commit and run it there (older copies lack the newer scenarios), then pass its
+output to --compare. Use a separate scratch database for each run.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    # Python < 3.7
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+# setup logging
+logger = logging.getLogger('main.benchmark')
+
+PAYLOADS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_payloads.json')
+SCENARIOS = ('/tv', '/series-search', '/watchlist', 'inbound', 'series-card', 'follow-toggle')
+SEARCH_TERMS = ('bre', 'brea', 'break', 'breaki', 'breaking', 'breaking b', 'the', 'gam', 'game of')
+BENCH_USER = {
+    'user_id': 'UBENCH0001',
+    'user_name': 'benchmark',
+    'channel_id': 'CBENCH0001'
+}
+BENCH_SERIES_ID = 169
+
+
+class NotFound(Exception):
+    pass
+
+
+class StandIn(object):
+    """
+    A local HTTP server posing as one of the external APIs.
+    `router(method, path, query, body)` returns the JSON-serializable response body.
+    """
+
+    def __init__(self, name, router, latency_ms=0, jitter_ms=0, error_rate=0.0, retry_after=0,
+                 throttled_body=None):
+        self.name = name
+        self.throttled_body = throttled_body or {'error': 'rate limited'}
+        self.router = router
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.stats = {
+            'requests': 0,
+            'throttled': 0
+        }
+        self._lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def start(self):
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real APIs
+
+            def do_GET(self):
+                stand_in.handle(self, 'GET')
+
+            def do_POST(self):
+                stand_in.handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        t = threading.Thread(target=self.server.serve_forever, name='standin-{}'.format(self.name))
+        t.daemon = True
+        t.start()
+
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+    def handle(self, request, method):
+
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        parts = urlsplit(request.path)
+
+        with self._lock:
+            self.stats['requests'] += 1
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.stats['throttled'] += 1
+            self.respond(request, 429, self.throttled_body, {'Retry-After': str(self.retry_after)})
+            return
+
+        try:
+            payload = self.router(method, parts.path, parse_qs(parts.query), body)
+        except NotFound:
+            self.respond(request, 404, {'name': 'Not Found', 'status': 404})
+            return
+        self.respond(request, 200, payload)
+
+    def respond(self, request, status, payload, headers=None):
+
+        data = json.dumps(payload).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(data)
+
+
+def tvmaze_router(payloads):
+
+    searchable = {result['show']['id']: result['show'] for result in payloads['search']}
+
+    def show_with_id(series_id, embeds=()):
+        show = json.loads(json.dumps(searchable.get(series_id, payloads['show'])))
+        if show['id'] != series_id:
+            show['_links']['self']['href'] = show['_links']['self']['href'].replace(
+                '/shows/{}'.format(show['id']), '/shows/{}'.format(series_id))
+            show['id'] = series_id
+        if embeds:
+            show['_embedded'] = {embed: payloads[embed] for embed in embeds if embed in payloads}
+        return show
+
+    def route(method, path, query, body):
+        match = re.match(r'^/shows/(\d+)$', path)
+        if match:
+            return show_with_id(int(match.group(1)), query.get('embed[]', []) + query.get('embed', []))
+        match = re.match(r'^/episodes/(\d+)$', path)
+        if match:
+            for key in ('previousepisode', 'nextepisode'):
+                if payloads[key]['id'] == int(match.group(1)):
+                    return payloads[key]
+            raise NotFound()
+        if path == '/search/shows':
+            return payloads['search']
+        if path in ('/singlesearch/shows', '/lookup/shows'):
+            return payloads['show']
+        if path == '/updates/shows':
+            return payloads['updates']
+        if path == '/shows':
+            if query.get('page', ['0'])[0] != '0':
+                raise NotFound()
+            return payloads['shows_page']
+        if path == '/schedule':
+            return []
+        raise NotFound()
+
+    return route
+
+
+def tvdb_router(payloads):
+
+    def route(method, path, query, body):
+        if path in ('/login', '/refresh_token'):
+            return payloads['login']
+        if re.match(r'^/series/\d+/images/query$', path):
+            return payloads['images']
+        if re.match(r'^/series/\d+$', path):
+            return payloads['series']
+        if path == '/search/series':
+            return payloads['search']
+        raise NotFound()
+
+    return route
+
+
+def slack_router(payloads):
+
+    def route(method, path, query, body):
+        if path.startswith('/actions/'):
+            # An interaction's response_url
+            return {'ok': True}
+        if not path.startswith('/api/'):
+            raise NotFound()
+        return payloads.get(path[len('/api/'):], {'ok': True})
+
+    return route
+
+
+def start_stand_ins(args):
+
+    with open(args.payloads) as f:
+        raw = f.read()
+
+    # Links inside the TVmaze payloads have to point back at the stand-in, whose port isn't known yet
+    tvmaze = StandIn('tvmaze', None, args.latency_ms, args.jitter_ms, args.error_rate, args.retry_after).start()
+    payloads = json.loads(raw.replace('{tvmaze_url}', tvmaze.url))
+    tvmaze.router = tvmaze_router(payloads['tvmaze'])
+    tvdb = StandIn('tvdb', tvdb_router(payloads['tvdb']),
+                   args.latency_ms, args.jitter_ms, args.error_rate, args.retry_after).start()
+    slack = StandIn('slack', slack_router(payloads['slack']),
+                    args.latency_ms, args.jitter_ms, args.error_rate, args.retry_after,
+                    throttled_body={'ok': False, 'error': 'ratelimited'}).start()
+
+    return {'tvmaze': tvmaze, 'tvdb': tvdb, 'slack': slack}
+
+
+def configure_environment(stand_ins, args):
+    # Must run before the app modules are imported; they read these at import time
+
+    os.environ['TVMAZE_API_URL'] = stand_ins['tvmaze'].url
+    os.environ['TVDB_API_URL'] = stand_ins['tvdb'].url
+    os.environ['SLACK_API_URL'] = stand_ins['slack'].url
+    os.environ.setdefault('SLACK_BOT_TOKEN', 'xoxb-benchmark')
+    os.environ.setdefault('TVDB_APIKEY', 'benchmark')
+    os.environ['SLACK_RATE_LIMITING'] = '0'
+    os.environ['DB_AUTO_MIGRATE'] = '1'
+
+
+def prepare_series_index(enabled):
+    """
+    Build the series catalog from the stand-in's /shows pages, or delete it so
+    /series-search goes to TVmaze. The index is loaded here, rather than on the
+    app's background thread, so the first searches are measured against it.
+    """
+
+    import series_index
+    from db_schema import Series_Catalog, create_db_session
+
+    if enabled:
+        series_index.update_catalog(full_rebuild=True)
+        series_index.load_index()
+        return
+
+    session = create_db_session()
+    session.query(Series_Catalog).delete()
+    session.commit()
+    session.close()
+
+
+def reset_caches():
+    """Forget everything cached in-process, so the next request takes the cold path"""
+
+    import tvmaze
+    tvmaze.response_cache.clear()
+    tvmaze.search_cache.clear()
+
+
+def build_scenarios(app):
+
+    import jarvis_app
+    import tvmaze
+
+    def tv(i):
+        return app.test_client().post('/tv', data=BENCH_USER).status_code
+
+    def series_search(i):
+        payload = json.dumps({'value': SEARCH_TERMS[i % len(SEARCH_TERMS)]})
+        return app.test_client().post('/series-search', data={'payload': payload}).status_code
+
+    def watchlist(i):
+        return app.test_client().post('/watchlist', data=BENCH_USER).status_code
+
+    def inbound(i):
+        payload = json.dumps({
+            'type': 'block_actions',
+            'user': {'id': BENCH_USER['user_id'], 'name': BENCH_USER['user_name']},
+            'channel': {'id': BENCH_USER['channel_id']},
+            'response_url': os.environ['SLACK_API_URL'] + '/actions/benchmark',
+            'actions': [{
+                'action_id': 'add_to_watchlist' if i % 2 == 0 else 'remove_from_watchlist',
+                'value': str(BENCH_SERIES_ID)
+            }]
+        })
+        return app.test_client().post('/', data={'payload': payload}).status_code
+
+    def follow_toggle(i):
+        # The follow/unfollow work inbound() queues, run inline so its latency is measured
+        if i % 2 == 0:
+            tvmaze.add_series_to_watchlist(str(BENCH_SERIES_ID), BENCH_USER['user_id'], BENCH_USER['user_name'])
+        else:
+            tvmaze.remove_series_from_watchlist(str(BENCH_SERIES_ID), BENCH_USER['user_id'])
+        return 200
+
+    def series_card(i):
+        # What a series_search selection runs in the background after inbound() acks
+        jarvis_app.respond_to_series_request(
+            BENCH_SERIES_ID, BENCH_USER['channel_id'], BENCH_USER['user_name'], BENCH_USER['user_id'])
+        return 200
+
+    return {
+        '/tv': tv,
+        '/series-search': series_search,
+        '/watchlist': watchlist,
+        'inbound': inbound,
+        'series-card': series_card,
+        'follow-toggle': follow_toggle
+    }
+
+
+class RoundTripCounter(object):
+    """Counts statements and commits sent to the database, i.e. its round trips"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'after_cursor_execute', self._statement)
+        event.listen(engine, 'commit', self._commit)
+
+    def _statement(self, *args):
+        with self._lock:
+            self.count += 1
+
+    def _commit(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def seed_database():
+    # The benchmark user follows every show in the search payload, so /watchlist has rows to render
+
+    import tvmaze
+    for option in tvmaze.search_for_series('breaking')['options']:
+        tvmaze.add_series_to_watchlist(option['value'], BENCH_USER['user_id'], BENCH_USER['user_name'])
+
+
+def percentile(sorted_values, fraction):
+
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name, fn, args):
+
+    for i in range(args.warmup):
+        fn(i)
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def timed(i):
+        if args.cold:
+            reset_caches()
+        start = time.time()
+        try:
+            status = fn(i)
+        except Exception as e:
+            logger.error('%s request %d raised: %s', name, i, e)
+            status = 500
+        elapsed = time.time() - start
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors[0] += 1
+
+    wall_start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(timed, range(args.requests)))
+    wall = time.time() - wall_start
+
+    latencies.sort()
+    result = {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50_ms': round(1000 * percentile(latencies, 0.50), 3),
+        'p95_ms': round(1000 * percentile(latencies, 0.95), 3),
+        'p99_ms': round(1000 * percentile(latencies, 0.99), 3),
+        'max_ms': round(1000 * latencies[-1], 3) if latencies else 0.0,
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else 0.0,
+        'wall_seconds': round(wall, 3)
+    }
+    print('{:<15} p50 {:8.2f}ms  p95 {:8.2f}ms  p99 {:8.2f}ms  {:8.1f} req/s  {} errors'.format(
+        name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['throughput_rps'], result['errors']))
+
+    return result
+
+
+def time_per_call(fn, rounds):
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return 1e6 * (time.perf_counter() - start) / rounds
+
+
+def codec_benchmark(rounds):
+    """
+    Time json_codec against what the app did before it (requests' .json() and the
+    standard library encoder behind jsonify/slackclient) on the card, search and
+    /tv payloads, as served by the stand-ins.
+    """
+
+    import json_codec
+    import jarvis_app
+    import tvmaze
+    import http_client
+
+    show_response = http_client.get(tvmaze.API_URL + '/shows/{}'.format(BENCH_SERIES_ID),
+                                    params={'embed[]': list(jarvis_app.CARD_EMBEDS)})
+    search_response = http_client.get(tvmaze.API_URL + '/search/shows', params={'q': 'breaking'})
+    # Every payload is built before timing starts, so both sides time the encoding alone
+    card = jarvis_app.format_series_output(json_codec.loads(show_response.content), BENCH_USER['user_name'])
+    search_options = tvmaze.search_for_series('breaking')
+    search_box = json.loads(jarvis_app.app.test_client().post('/tv', data=BENCH_USER).data)
+
+    cases = [
+        ('decode show', show_response.json, lambda: json_codec.loads(show_response.content)),
+        ('decode search', search_response.json, lambda: json_codec.loads(search_response.content)),
+        ('encode card', lambda: json.dumps(card), lambda: json_codec.dumps(card)),
+        ('encode search', lambda: json.dumps(search_options), lambda: json_codec.dumps(search_options)),
+        ('encode /tv', lambda: json.dumps(search_box), lambda: json_codec.dumps(search_box)),
+    ]
+
+    results = {}
+    print('JSON codec backend: {}'.format(json_codec.backend))
+    for name, before, after in cases:
+        before_us = time_per_call(before, rounds)
+        after_us = time_per_call(after, rounds)
+        results[name] = {
+            'before_us': round(before_us, 3),
+            'after_us': round(after_us, 3),
+            'speedup': round(before_us / after_us, 2) if after_us else None
+        }
+        print('{:<15} before {:9.2f}us  after {:9.2f}us  {:6.2f}x'.format(
+            name, before_us, after_us, results[name]['speedup'] or 0))
+
+    return {'backend': json_codec.backend, 'rounds': rounds, 'results': results}
+
+
+def git_commit():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous_path, current):
+
+    with open(previous_path) as f:
+        previous = json.load(f)
+
+    print('{:<15} {:>10} {:>22} {:>22} {:>22}'.format('scenario', 'metric', 'before', 'after', 'change'))
+    for name, result in sorted(current['results'].items()):
+        before = previous.get('results', {}).get(name)
+        if not before:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'db_round_trips_per_request'):
+            if metric not in before or metric not in result:
+                continue
+            old, new = before[metric], result[metric]
+            change = '{:+.1f}%'.format(100.0 * (new - old) / old) if old else 'n/a'
+            print('{:<15} {:>10} {:>22} {:>22} {:>22}'.format(name, metric, old, new, change))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the Jarvis endpoints against local API stand-ins')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='stand-in response latency')
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of stand-in responses that are 429s')
+    parser.add_argument('--retry-after', type=int, default=0, help='Retry-After seconds sent with injected 429s')
+    parser.add_argument('--cold', action='store_true', help='clear in-process caches before every request')
+    parser.add_argument('--payloads', default=PAYLOADS_PATH, help='JSON file of recorded API payloads')
+    parser.add_argument('--series-index', action='store_true',
+                        help='serve /series-search from a series index built from the stand-in (default: live search)')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--codec-rounds', type=int, default=0,
+                        help='also micro-benchmark JSON encode/decode with this many rounds per payload')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if 'DATABASE_URL' not in os.environ:
+        sys.exit('Set DATABASE_URL to a scratch Postgres database')
+    random.seed(args.seed)
+
+    stand_ins = start_stand_ins(args)
+    configure_environment(stand_ins, args)
+
+    prepare_series_index(args.series_index)
+    import jobs
+    import jarvis_app
+    # Only warnings and errors from the app, so the benchmark output stays readable
+    logging.getLogger('main').setLevel(logging.WARNING)
+
+    seed_database()
+    scenarios = build_scenarios(jarvis_app.app)
+    from db_schema import get_db_engine
+    round_trips = RoundTripCounter(get_db_engine())
+
+    results = {}
+    for name in args.scenarios:
+        round_trips_before = round_trips.count
+        results[name] = run_scenario(name, scenarios[name], args)
+        # Let background jobs from this scenario finish before timing the next one
+        jobs.background.join()
+        calls = args.warmup + args.requests
+        results[name]['db_round_trips_per_request'] = round((round_trips.count - round_trips_before) / calls, 2)
+        print('{:<15} {:.2f} database round trips per request'.format(name, results[name]['db_round_trips_per_request']))
+
+    report = {
+        'run': {
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'git_commit': git_commit(),
+            'python': sys.version.split()[0],
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+        },
+        'results': results,
+        'stand_ins': {name: stand_in.stats for name, stand_in in stand_ins.items()}
+    }
+    if args.codec_rounds:
+        report['codec'] = codec_benchmark(args.codec_rounds)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+    if args.compare:
+        compare(args.compare, report)
+
+    for stand_in in stand_ins.values():
+        stand_in.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Bulk watchlist import and export, for users bringing their shows over from another tracker.
+An import is a list of entries, one per line (or separated by semicolons): a show
+title, `tvmaze:<id>` or an IMDB id such as `tt0903747`. Text after a `#` is ignored,
+so an export can be imported again as-is.
+"""
+import os
+import re
+import logging
+import requests
+import tvmaze
+import watchlist
+import json_codec
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.dialects.postgresql import insert
+from slack import post_message, post_file, get_dm_channel
+from db_schema import User, TV_Series, Follow, create_db_session
+
+# setup logging
+logger = logging.getLogger('main.bulk_watchlist')
+
+# Constants
+MAX_ENTRIES = int(os.environ.get('BULK_MAX_ENTRIES', 500))
+RESOLVE_WORKERS = int(os.environ.get('BULK_RESOLVE_WORKERS', 4))
+RESOLVE_BATCH = 25  # entries resolved between progress messages
+MAX_UNRESOLVED_LISTED = 20
+
+TVMAZE_ENTRY = re.compile(r'^tvmaze:\s*(\d+)$', re.IGNORECASE)
+IMDB_ENTRY = re.compile(r'^(tt\d{7,})$', re.IGNORECASE)
+
+
+def parse_entries(text):
+    """[(kind, value)] for each distinct entry in `text`, kind being 'tvmaze', 'imdb' or 'title'"""
+
+    entries = []
+    seen = set()
+    for line in re.split(r'[\r\n;]+', text or ''):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        tvmaze_match = TVMAZE_ENTRY.match(line)
+        imdb_match = IMDB_ENTRY.match(line)
+        if tvmaze_match:
+            entry = ('tvmaze', int(tvmaze_match.group(1)))
+        elif imdb_match:
+            entry = ('imdb', imdb_match.group(1).lower())
+        else:
+            entry = ('title', line)
+        if entry not in seen:
+            seen.add(entry)
+            entries.append(entry)
+
+    return entries
+
+
+def format_entry(entry):
+
+    kind, value = entry
+    if kind == 'tvmaze':
+        return 'tvmaze:{}'.format(value)
+    return str(value)
+
+
+def resolve_entry(entry, fresh_ids):
+    """
+    Find the TVmaze series for an entry. Returns (tvmaze_id, series_data), where
+    series_data is None for a series whose row is already fresh, or None if the
+    entry didn't match anything. Lookups go through the shared TVmaze rate limiter.
+    """
+
+    kind, value = entry
+    if kind == 'title':
+        response = tvmaze.fetch_with_backoff(tvmaze.API_URL + '/singlesearch/shows',
+                                             params={'q': value, 'embed': 'nextepisode'})
+        if response.status_code != 200:
+            return None
+        series_data = json_codec.loads(response.content)
+        return series_data['id'], series_data
+
+    if kind == 'imdb':
+        # The lookup answers with the show itself, so it isn't fetched again
+        response = tvmaze.fetch_with_backoff(tvmaze.API_URL + '/lookup/shows',
+                                             params={'imdb': value, 'embed': 'nextepisode'})
+        if response.status_code != 200:
+            return None
+        series_data = embed_next_episode(json_codec.loads(response.content))
+        if series_data is None:
+            return None
+        return series_data['id'], series_data
+
+    series_id = value
+
+    if series_id in fresh_ids:
+        return series_id, None
+
+    series_data = tvmaze.get_series_with_next_episode(series_id)
+    if series_data is None:
+        return None
+
+    return series_id, series_data
+
+
+def embed_next_episode(series_data):
+    """
+    Make sure a show payload has its next episode embedded, as if fetched with
+    embed=nextepisode. TVmaze drops the embed when it redirects a lookup to the
+    show, so the episode is then fetched from its link. None if that fails.
+    """
+
+    next_episode_link = series_data.get('_links', {}).get('nextepisode')
+    if 'nextepisode' in series_data.get('_embedded', {}) or not next_episode_link:
+        return series_data
+
+    response = tvmaze.fetch_with_backoff(next_episode_link['href'])
+    if response.status_code != 200:
+        logger.warning("Could not fetch the next episode of series_id '%s'. Status code: %s",
+                       series_data['id'], response.status_code)
+        return None
+    series_data.setdefault('_embedded', {})['nextepisode'] = json_codec.loads(response.content)
+
+    return series_data
+
+
+def find_fresh_series(entries):
+    """tvmaze ids among the `tvmaze:` entries whose rows don't need refetching"""
+
+    ids = [value for kind, value in entries if kind == 'tvmaze']
+    if not ids:
+        return set()
+
+    session = create_db_session()
+    known = session.query(TV_Series). \
+        filter(TV_Series.tvmaze_id.in_(ids)). \
+        all()
+    fresh_ids = set(series.tvmaze_id for series in known if tvmaze.is_fresh(series))
+    session.close()
+
+    return fresh_ids
+
+
+def resolve_entries(entries, progress=None):
+    """
+    Resolve entries in batches of RESOLVE_BATCH on RESOLVE_WORKERS threads.
+    Returns ({tvmaze_id: series_data or None}, [unresolved entries]).
+    `progress(done, total)` is called after each batch.
+    """
+
+    fresh_ids = find_fresh_series(entries)
+    resolved = {}
+    unresolved = []
+
+    def resolve(entry):
+        try:
+            return resolve_entry(entry, fresh_ids)
+        except requests.RequestException as e:
+            logger.error("Could not resolve '%s': %s", format_entry(entry), e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=RESOLVE_WORKERS) as executor:
+        for start in range(0, len(entries), RESOLVE_BATCH):
+            batch = entries[start:start + RESOLVE_BATCH]
+            for entry, result in zip(batch, executor.map(resolve, batch)):
+                if result is None:
+                    unresolved.append(entry)
+                    continue
+                series_id, series_data = result
+                if resolved.get(series_id) is None:
+                    resolved[series_id] = series_data
+            if progress:
+                progress(start + len(batch), len(entries))
+
+    return resolved, unresolved
+
+
+def bulk_follow(slack_id, slack_name, resolved):
+    """
+    Follow many series in one transaction.
+    `resolved` maps tvmaze ids to fresh series payloads (embed=nextepisode), or to
+    None for series whose rows are already current. New series and all the follows
+    are written with multi-row INSERT ... ON CONFLICT statements and the user's
+    watchlist summary is rebuilt once. Returns the number of series newly followed.
+    """
+
+    if not resolved:
+        return 0
+
+    session = create_db_session()
+    user_pk = tvmaze.upsert_user(session, slack_id, slack_name)
+
+    existing = {
+        series.tvmaze_id: series
+        for series in session.query(TV_Series).filter(TV_Series.tvmaze_id.in_(list(resolved)))
+    }
+
+    # Rows we already have are refreshed in place; their followers' summaries may need patching
+    changed_series = [
+        series for series_id, series in existing.items()
+        if resolved[series_id] and tvmaze.apply_series_data(series, resolved[series_id])
+    ]
+    watchlist.update_series_in_summaries(session, changed_series)
+
+    new_series = [
+        dict(tvmaze.series_columns(series_data), tvmaze_id=series_id)
+        for series_id, series_data in resolved.items()
+        if series_id not in existing and series_data
+    ]
+    series_ids = [series.id for series in existing.values()]
+    if new_series:
+        series_table = TV_Series.__table__
+        statement = insert(series_table).values(new_series)
+        statement = statement.on_conflict_do_update(
+            index_elements=[series_table.c.tvmaze_id],
+            set_={column: getattr(statement.excluded, column) for column in new_series[0] if column != 'tvmaze_id'}
+        ).returning(series_table.c.id)
+        series_ids += [row.id for row in session.execute(statement)]
+    if not series_ids:
+        session.close()
+        return 0
+
+    follows = Follow.__table__
+    statement = insert(follows).values([
+        {'user_id': user_pk, 'tv_series_id': series_id, 'is_following': True}
+        for series_id in series_ids
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=[follows.c.user_id, follows.c.tv_series_id],
+        set_={'is_following': True},
+        where=follows.c.is_following.is_distinct_from(True)
+    ).returning(follows.c.tv_series_id)
+    newly_followed = len(session.execute(statement).fetchall())
+
+    watchlist.refresh_summary(session, user_pk)
+    session.commit()
+    session.close()
+
+    return newly_followed
+
+
+def import_watchlist(text, slack_id, slack_name, channel_id):
+    """Slash command job: resolve the entries in `text` and follow them all"""
+
+    entries = parse_entries(text)
+    if not entries:
+        notify(channel_id, slack_id, "Nothing to import. List one show per line: a title, `tvmaze:<id>` or an IMDB id.")
+        return
+    if len(entries) > MAX_ENTRIES:
+        notify(channel_id, slack_id, "That's {} shows. Imports are limited to {} at a time.".format(len(entries), MAX_ENTRIES))
+        return
+
+    start_time = datetime.utcnow()
+    logger.info("Importing %d watchlist entries for '%s'", len(entries), slack_id)
+
+    def progress(done, total):
+        if done < total:
+            notify(channel_id, slack_id, "_Looked up {} of {} shows..._".format(done, total))
+
+    resolved, unresolved = resolve_entries(entries, progress)
+    newly_followed = bulk_follow(slack_id, slack_name, resolved)
+
+    text = "_Imported your watchlist: now following {} more show(s), {} already followed._".format(
+        newly_followed, len(resolved) - newly_followed)
+    if unresolved:
+        listed = ', '.join(format_entry(entry) for entry in unresolved[:MAX_UNRESOLVED_LISTED])
+        if len(unresolved) > MAX_UNRESOLVED_LISTED:
+            listed += ' and {} more'.format(len(unresolved) - MAX_UNRESOLVED_LISTED)
+        text += "\nCouldn't find: {}".format(listed)
+    notify(channel_id, slack_id, text)
+
+    logger.info("Imported %d entries for '%s' in %.1fs: %d resolved, %d newly followed, %d unresolved",
+                len(entries), slack_id, (datetime.utcnow() - start_time).total_seconds(),
+                len(resolved), newly_followed, len(unresolved))
+
+
+def export_lines(slack_id):
+    """The user's followed series, one `tvmaze:<id> # name` line each, sorted by name"""
+
+    session = create_db_session()
+    rows = session.query(TV_Series.tvmaze_id, TV_Series.name). \
+        join(Follow, Follow.tv_series_id == TV_Series.id). \
+        join(User, User.id == Follow.user_id). \
+        filter(User.slack_id == slack_id). \
+        filter(Follow.is_following == True). \
+        order_by(TV_Series.name). \
+        all()
+    session.close()
+
+    return ['tvmaze:{} # {}'.format(tvmaze_id, name) for tvmaze_id, name in rows]
+
+
+def export_watchlist(slack_id, slack_name, channel_id):
+    """Slash command job: send the user their watchlist as a file they can import later"""
+
+    lines = export_lines(slack_id)
+    if not lines:
+        notify(channel_id, slack_id, "You're not following any TV shows yet. Use `/tv` to follow some shows first.")
+        return
+
+    title = 'Watchlist export for {} ({} shows)'.format(slack_name, len(lines))
+    post_file(get_dm_channel(slack_id) or channel_id, '\n'.join(lines) + '\n', title)
+
+
+def notify(channel_id, slack_id, text):
+
+    blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": text
+            }
+        }
+    ]
+    post_message(blocks, channel_id=channel_id, slack_id=slack_id, ephemeral=True)
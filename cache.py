@@ -0,0 +1,163 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache with per-entry TTLs.
+    Entries are evicted least-recently-used first once either `max_entries` or
+    `max_bytes` (the summed size of the cached values) is exceeded.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0
+        }
+
+    def get(self, key):
+        """Return the cached value for `key`, or None if it is missing or expired"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl, size=None):
+
+        if size is None:
+            size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.time() + ttl, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key):
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+
+        return stats
+
+    def _remove(self, key):
+        # Caller holds the lock
+        value, expires_at, size = self._entries.pop(key)
+        self._bytes -= size
+
+
+def estimate_size(value):
+    """Approximate a value's footprint by the length of its JSON encoding"""
+
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return 1024
+
+
+class PrefixCache(object):
+    """
+    Type-ahead search cache keyed by normalized query.
+    A query that isn't cached is answered from its longest cached prefix, as long
+    as that prefix's result set was complete (the API returned every match, so
+    every match for the longer query is in it): the set is passed through
+    `refine(results, query)` to filter and re-rank it. Entries share one LRUCache.
+    """
+
+    def __init__(self, refine, max_entries=1000, max_bytes=4 * 1024 * 1024, min_prefix=1):
+        self.refine = refine
+        self.min_prefix = min_prefix
+        self._entries = LRUCache(max_entries, max_bytes)  # query -> (results, complete)
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'prefix_hits': 0,
+            'misses': 0
+        }
+
+    def get(self, query):
+        """Return results for `query`, or None if it has to be looked up"""
+
+        entry = self._entries.get(query)
+        if entry is not None:
+            self._count('hits')
+            return entry[0]
+
+        for end in range(len(query) - 1, self.min_prefix - 1, -1):
+            entry = self._entries.get(query[:end])
+            if entry is not None and entry[1]:
+                self._count('prefix_hits')
+                return self.refine(entry[0], query)
+
+        self._count('misses')
+        return None
+
+    def set(self, query, results, complete, ttl):
+
+        self._entries.set(query, (results, complete), ttl)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+
+        with self._lock:
+            stats = dict(self._stats)
+        entries = self._entries.stats()
+        for key in ('entries', 'bytes', 'evictions', 'expirations'):
+            stats[key] = entries[key]
+        # Every hit, exact or from a prefix, is a network call that wasn't made
+        stats['saved_calls'] = stats['hits'] + stats['prefix_hits']
+        lookups = stats['saved_calls'] + stats['misses']
+        stats['hit_rate'] = round(stats['saved_calls'] / lookups, 4) if lookups else 0.0
+
+        return stats
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
@@ -1,9 +1,23 @@
+import os
+import time
+import argparse
 import requests
 import logging
+import itertools
 import collections
+import log_setup
+import tvmaze
+import http_client
+import series_index
+import watchlist
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import exists
 from slack import post_message
 from datetime import date, datetime
-from db_schema import Base, User, TV_Series, Follow, create_db_session
+from db_schema import Base, User, TV_Series, Follow, Report_Delivery, create_db_session
+
+# setup logging
+logger = logging.getLogger('main.daily_tasks')
 
 # static variables
 watchlist_categories = {
@@ -11,47 +25,112 @@ watchlist_categories = {
     'unknown': 'unknown_next_episode',
     'cancelled': 'cancelled'
 }
+REFRESH_WORKERS = int(os.environ.get('REFRESH_WORKERS', 4))
+REFRESH_COMMIT_BATCH = 100
+WATCHLIST_FETCH_SIZE = 1000
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', 4))
+CLEANUP_BATCH = int(os.environ.get('CLEANUP_BATCH', 500))
 
 
-def database_update():
+def database_update(full_refresh=False, show_updates=None):
+    """
+    Refresh series from TVmaze.
+    Only series that TVmaze reports as changed since our copy (or whose next
+    episode has already aired) are fetched, unless full_refresh is set.
+    Lookups run on a small worker pool and share tvmaze.rate_limiter, so the pool
+    never outruns the API; database writes stay on this thread.
+    """
 
-    logger.info('Starting database update')
+    logger.info('Starting database update (full refresh: %s)', full_refresh)
+    start_time = time.time()
+    requests_before = http_client.host_stats(tvmaze.API_HOST)
 
     session = create_db_session()
 
     all_series = session.query(TV_Series).all()
-    for series in all_series:
-        series_data = requests.get(series.api_url).json()
-        try:
-            next_episode_api_url = series_data['_links']['nextepisode']['href']
-        except KeyError:
-            next_episode_api_url = None
-            next_episode_season = None
-            next_episode_number = None
-            next_episode_name = None
-            next_episode_date = None
-
-        if next_episode_api_url:
-            episode_data = requests.get(next_episode_api_url).json()
-            next_episode_season = episode_data.get('season')
-            next_episode_number = episode_data.get('number')
-            next_episode_name = episode_data.get('name')
-            next_episode_date = datetime.strptime(episode_data.get('airdate'), '%Y-%m-%d')
-
-        series.status = series_data.get('status')
-        series.next_episode_season = next_episode_season
-        series.next_episode_number = next_episode_number
-        series.next_episode_name = next_episode_name
-        series.next_episode_date = next_episode_date
-        series.next_episode_api_url = series.next_episode_api_url
+    if full_refresh:
+        stale_series = all_series
+    else:
+        if show_updates is None:
+            show_updates = tvmaze.get_show_updates()
+        if show_updates is None:
+            logger.warning('Falling back to a full refresh')
+            stale_series = all_series
+        else:
+            today = date.today()
+            stale_series = [s for s in all_series if needs_refresh(s, show_updates, today)]
+    logger.info('%d of %d series need refreshing', len(stale_series), len(all_series))
+
+    # TVmaze vouches for the rest being unchanged, so they count as freshly checked
+    stale_ids = set(s.id for s in stale_series)
+    current_ids = [s.id for s in all_series if s.id not in stale_ids]
+    if current_ids:
+        session.query(TV_Series). \
+            filter(TV_Series.id.in_(current_ids)). \
+            update({'refreshed_at': datetime.utcnow()}, synchronize_session=False)
+
+    updated = 0
+    failed = 0
+    changed_series = []  # name or status changed, so their watchlist summaries need patching
+
+    with ThreadPoolExecutor(max_workers=REFRESH_WORKERS) as executor:
+        futures = {
+            executor.submit(tvmaze.get_series_with_next_episode, series.tvmaze_id): series
+            for series in stale_series
+        }
+        for future in as_completed(futures):
+            series = futures[future]
+            try:
+                series_data = future.result()
+            except requests.RequestException as e:
+                logger.error("Failed to refresh '%s': %s", series.name, e)
+                series_data = None
+
+            if not series_data:
+                failed += 1
+                continue
+
+            if tvmaze.apply_series_data(series, series_data):
+                changed_series.append(series)
+
+            updated += 1
+            if updated % REFRESH_COMMIT_BATCH == 0:
+                watchlist.update_series_in_summaries(session, changed_series)
+                changed_series = []
+                session.commit()
+
+    watchlist.update_series_in_summaries(session, changed_series)
+    session.commit()
+    session.close()
 
-        session.commit()
+    runtime = time.time() - start_time
+    requests_after = http_client.host_stats(tvmaze.API_HOST)
+    stats = {
+        'series': len(all_series),
+        'stale': len(stale_series),
+        'updated': updated,
+        'failed': failed,
+        'requests': requests_after['requests'] - requests_before['requests'],
+        'retries': requests_after['retries'] - requests_before['retries'],
+        'runtime_seconds': round(runtime, 2),
+        'series_per_second': round(updated / runtime, 2) if runtime else 0.0
+    }
+    logger.info('Finished database update: %s', stats)
 
-    session.close()
+    return stats
 
-    logger.info('Finished database update')
 
-    return
+def needs_refresh(series, show_updates, today):
+
+    if series.updated is None:
+        return True
+    if show_updates.get(series.tvmaze_id, 0) > series.updated:
+        return True
+    # Airing an episode doesn't touch the show's timestamp, but it does move the next episode
+    if series.next_episode_date and series.next_episode_date < today:
+        return True
+
+    return False
 
 
 def create_watchlist_report():
@@ -62,57 +141,75 @@ def create_watchlist_report():
 
 
 def collect_watchlist_data():
+    """
+    Build {slack_id: {watchlist_category: {series_name: series_info}}} for every user
+    following at least one series. A single joined query streams the follows
+    ordered by user, so the query count doesn't grow with users or follows.
+    """
 
     logger.info('Collecting watchlist data')
     watchlist_data = {}
     session = create_db_session()
 
-    all_series = session.query(TV_Series).all()
-
-    for series in all_series:
-        if series.next_episode_date:
-            watchlist_category = watchlist_categories['known']
-        else:
-            if series.status == 'Running':
-                watchlist_category = watchlist_categories['unknown']
+    follows = watchlist_report_query(session).yield_per(WATCHLIST_FETCH_SIZE)
+
+    for slack_id, user_follows in itertools.groupby(follows, key=lambda row: row.slack_id):
+        user_watchlist = {
+            watchlist_categories['known']: {},
+            watchlist_categories['unknown']: {},
+            watchlist_categories['cancelled']: {}
+        }
+        for series in user_follows:
+            if series.next_episode_date:
+                watchlist_category = watchlist_categories['known']
             else:
-                watchlist_category = watchlist_categories['cancelled']
-            
-        followers = session.query(Follow.user_id).filter_by(tv_series_id=series.id, is_following=True).all()
-        followers = [f[0] for f in followers]  # list comprehension to create list variable
-        for follower in followers:
-            slack_id = session.query(User.slack_id).filter_by(id=follower).scalar()
-            if not watchlist_data.get(slack_id):
-                watchlist_data[slack_id] = {
-                    watchlist_categories['known']: {},
-                    watchlist_categories['unknown']: {},
-                    watchlist_categories['cancelled']: {}
-                }
+                if series.status == 'Running':
+                    watchlist_category = watchlist_categories['unknown']
+                else:
+                    watchlist_category = watchlist_categories['cancelled']
 
-            watchlist_data[slack_id][watchlist_category][series.name] = {
+            user_watchlist[watchlist_category][series.name] = {
                 'series_name': series.name,
                 'series_status': series.status,
                 'next_episode_date': series.next_episode_date,
                 'next_episode_season': series.next_episode_season,
                 'next_episode_number': series.next_episode_number
             }
+        watchlist_data[slack_id] = user_watchlist
 
     session.close()
-    logger.info('Finished watchlist data collection')
+    logger.info('Finished watchlist data collection for %d users', len(watchlist_data))
     
     return watchlist_data
 
 
+def watchlist_report_query(session):
+    """Every active follow with its user's Slack id and the series' next episode, ordered by user"""
+
+    return session.query(
+            User.slack_id,
+            TV_Series.name,
+            TV_Series.status,
+            TV_Series.next_episode_date,
+            TV_Series.next_episode_season,
+            TV_Series.next_episode_number
+        ). \
+        join(Follow, Follow.user_id == User.id). \
+        join(TV_Series, TV_Series.id == Follow.tv_series_id). \
+        filter(Follow.is_following == True). \
+        order_by(User.slack_id)
+
+
 def format_watchlist_report(watchlist_data):
 
     logger.info('Formatting watchlist reports')
 
     watchlist_reports = {}
-    for slack_id, watchlist in watchlist_data.items():
+    for slack_id, user_watchlist in watchlist_data.items():
 
         scheduled_episodes = {}
         today = date.today()
-        for series in watchlist[watchlist_categories['known']].values():
+        for series in user_watchlist[watchlist_categories['known']].values():
             days_until = (series['next_episode_date'] - today).days
             notification = '{} `s{}.e{}`'.format(
                 series['series_name'],
@@ -156,85 +253,212 @@ def format_watchlist_report(watchlist_data):
     return watchlist_reports
 
 
-def send_watchlist_reports(watchlist_reports):
-
-    for slack_id, user_report in watchlist_reports.items():
-        blocks = [
-            {
-                "type": "context",
-                "elements": [
-                    {
-                        "type": "mrkdwn",
-                        "text": "Daily watchlist report"
-                    }
-                ]
-            },
-            {
-                "type": "section",
-                "text": {
+def send_watchlist_reports(watchlist_reports, report_date=None):
+    """
+    Deliver the reports from a pool of REPORT_WORKERS threads. Slack rate limits and
+    retries are handled by slack.api_call. Every delivery is written to the
+    report_deliveries ledger, so re-running an interrupted job skips users who
+    already received today's report.
+    """
+
+    report_date = report_date or date.today()
+    start_time = time.time()
+
+    session = create_db_session()
+    delivered = set(
+        row.slack_id for row in session.query(Report_Delivery.slack_id).filter_by(report_date=report_date)
+    )
+    session.close()
+
+    pending = [(slack_id, report) for slack_id, report in watchlist_reports.items() if slack_id not in delivered]
+    logger.info('Sending %d watchlist reports (%d already delivered)', len(pending), len(watchlist_reports) - len(pending))
+
+    sent = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=REPORT_WORKERS) as executor:
+        futures = [
+            executor.submit(send_watchlist_report, slack_id, user_report, report_date)
+            for slack_id, user_report in pending
+        ]
+        for future in as_completed(futures):
+            try:
+                ok = future.result()
+            except Exception as e:
+                logger.error('Watchlist report delivery raised: %s', e)
+                ok = False
+            if ok:
+                sent += 1
+            else:
+                failed += 1
+
+    stats = {
+        'reports': len(watchlist_reports),
+        'skipped': len(watchlist_reports) - len(pending),
+        'sent': sent,
+        'failed': failed,
+        'runtime_seconds': round(time.time() - start_time, 2)
+    }
+    logger.info('Finished sending watchlist reports: %s', stats)
+
+    return stats
+
+
+def send_watchlist_report(slack_id, user_report, report_date):
+
+    blocks = [
+        {
+            "type": "context",
+            "elements": [
+                {
                     "type": "mrkdwn",
-                    "text": user_report
+                    "text": "Daily watchlist report"
                 }
+            ]
+        },
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": user_report
             }
-        ]
-        post_message(blocks, slack_id=slack_id)
+        }
+    ]
+    response = post_message(blocks, slack_id=slack_id)
+    if not response.get('ok'):
+        logger.error("Watchlist report for '%s' was not delivered: %s", slack_id, response.get('error'))
+        return False
+
+    session = create_db_session()
+    session.add(Report_Delivery(
+        slack_id=slack_id,
+        report_date=report_date,
+        delivered_at=datetime.utcnow()
+    ))
+    session.commit()
+    session.close()
 
+    return True
 
-def database_cleanup():
+
+def database_cleanup(dry_run=False):
     """
-    find tv series and users no longer used
-    for each tv series in database...
-    query follow table for tv series where no "is_following" fields are True
-    :return:
+    Delete series that nobody follows and users who follow nothing.
+    Each set is found with one anti-join (NOT EXISTS an active follow) and deleted
+    in batches of CLEANUP_BATCH, committing after every batch so no long
+    transaction holds locks. The deletes re-check the anti-join, so a follow made
+    since the scan keeps its series and user. With dry_run, only the counts are
+    reported.
     """
 
-    logger.info("Starting database cleanup.")
+    logger.info("Starting database cleanup (dry run: %s)", dry_run)
+    start_time = time.time()
 
     session = create_db_session()
 
-    series_list = session.query(TV_Series).all()
-
-    for series in series_list:
-        series_followers = session.query(Follow). \
-            filter_by(tv_series_id=series.id). \
-            filter_by(is_following=True). \
-            all()
-        if len(series_followers) == 0:
-            print(series.name + " has 0 followers. Marking for removal from database.")
-            session.query(Follow). \
-                filter_by(tv_series_id=series.id). \
-                delete()
-            session.query(TV_Series). \
-                filter_by(id=series.id). \
-                delete()
+    series_followed = series_followed_clause()
+    user_follows = user_follows_clause()
+
+    orphan_series = [row[0] for row in orphan_series_query(session)]
+    idle_users = [row[0] for row in idle_users_query(session)]
+    logger.info("Found %d series without followers and %d users without follows",
+                len(orphan_series), len(idle_users))
+
+    stats = {
+        'orphan_series': len(orphan_series),
+        'idle_users': len(idle_users),
+        'series_deleted': 0,
+        'users_deleted': 0,
+        'follows_deleted': 0,
+        'dry_run': dry_run
+    }
+    if dry_run:
+        session.close()
+        logger.info('Finished database cleanup: %s', stats)
+        return stats
+
+    for batch in chunks(orphan_series, CLEANUP_BATCH):
+        stats['follows_deleted'] += session.query(Follow). \
+            filter(Follow.tv_series_id.in_(batch)). \
+            filter(Follow.is_following.isnot(True)). \
+            delete(synchronize_session=False)
+        stats['series_deleted'] += session.query(TV_Series). \
+            filter(TV_Series.id.in_(batch)). \
+            filter(~series_followed). \
+            delete(synchronize_session=False)
+        session.commit()
+
+    for batch in chunks(idle_users, CLEANUP_BATCH):
+        stats['follows_deleted'] += session.query(Follow). \
+            filter(Follow.user_id.in_(batch)). \
+            filter(Follow.is_following.isnot(True)). \
+            delete(synchronize_session=False)
+        # Their watchlist summaries go with them (ON DELETE CASCADE)
+        stats['users_deleted'] += session.query(User). \
+            filter(User.id.in_(batch)). \
+            filter(~user_follows). \
+            delete(synchronize_session=False)
+        session.commit()
 
-    session.commit()
     session.close()
 
-    logger.info("Finished database cleanup")
+    stats['runtime_seconds'] = round(time.time() - start_time, 2)
+    logger.info('Finished database cleanup: %s', stats)
 
+    return stats
 
-if __name__ == "__main__":
 
-    # setup logging
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+def series_followed_clause():
+
+    return exists(). \
+        where(Follow.tv_series_id == TV_Series.id). \
+        where(Follow.is_following == True)
 
-    fh = logging.FileHandler('daily_tasks.log')
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
 
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-    ch.setFormatter(formatter)
+def user_follows_clause():
 
-    logger = logging.getLogger('main')
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    return exists(). \
+        where(Follow.user_id == User.id). \
+        where(Follow.is_following == True)
+
+
+def orphan_series_query(session):
+    """Ids of series nobody follows (an anti-join on the active follows)"""
+
+    return session.query(TV_Series.id).filter(~series_followed_clause())
+
+
+def idle_users_query(session):
+    """Ids of users who follow nothing"""
+
+    return session.query(User.id).filter(~user_follows_clause())
+
+
+def chunks(items, size):
+
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run the daily Jarvis maintenance tasks')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='refresh every series instead of only those TVmaze reports as changed')
+    parser.add_argument('--cleanup-dry-run', action='store_true',
+                        help='report how many series and users cleanup would delete, without deleting them')
+    args = parser.parse_args()
+
+    # setup logging
+    logger = log_setup.configure_logging('daily_tasks.log')
 
     # begin tasks
-    database_cleanup()
-    database_update()
+    database_cleanup(dry_run=args.cleanup_dry_run)
+    show_updates = tvmaze.get_show_updates()
+    database_update(full_refresh=args.full_refresh, show_updates=show_updates)
+    try:
+        series_index.update_catalog(show_updates=show_updates)
+    except requests.RequestException as e:
+        logger.error('Series index update failed: %s', e)
 
     if date.today().weekday() == 0:
         logger.info("Running Monday watchlist report")
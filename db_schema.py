@@ -1,10 +1,19 @@
 import psycopg2
 import os
-from sqlalchemy import Table, Column, ForeignKey, Integer, String, Boolean, Date
+import time
+import threading
+import logging
+import metrics
+from sqlalchemy import Table, Column, ForeignKey, Index, Integer, String, Boolean, Date, DateTime, LargeBinary, text
+from sqlalchemy.types import JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+
+# setup logging
+logger = logging.getLogger('main.db_schema')
 
 Base = declarative_base()
 
@@ -21,6 +30,14 @@ class Follow(Base):
     user = relationship('User', back_populates='series_followed')
     tv_series = relationship('TV_Series', back_populates='followed_by')
 
+    # Only active follows are ever looked up, so the indexes skip the rest
+    __table_args__ = (
+        # a user's watchlist (index-only scan for the series ids)
+        Index('ix_follows_user_following', 'user_id', 'tv_series_id', postgresql_where=text('is_following')),
+        # a series' followers: watchlist reports and orphan cleanup
+        Index('ix_follows_series_following', 'tv_series_id', 'user_id', postgresql_where=text('is_following')),
+    )
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -30,6 +47,7 @@ class User(Base):
     slack_id = Column(String(30), unique=True, nullable=False)
     slack_name = Column(String(30), unique=True, nullable=False)
     notifications = Column('Receive Notifications', Boolean, unique=False, default=True)
+    dm_channel_id = Column(String(30))  # bot's DM channel with the user, filled on first DM
 
     # Relationships
     series_followed = relationship('Follow', cascade='all, delete-orphan', back_populates='user')
@@ -49,31 +67,222 @@ class TV_Series(Base):
     next_episode_name = Column(String(50))
     next_episode_date = Column(Date)
     next_episode_api_url = Column(String(100))
+    updated = Column(Integer)  # TVmaze's last-modified timestamp (epoch seconds)
+    refreshed_at = Column(DateTime)  # when the row was last confirmed current with TVmaze
     
     # Relationships
     followed_by = relationship('Follow', cascade='all, delete-orphan', back_populates='tv_series')
 
 
+class Watchlist_Summary(Base):
+    __tablename__ = 'watchlist_summaries'
+
+    # Columns
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    items = Column(JSON, nullable=False)  # [{'id', 'name', 'status'}] of followed series, sorted by name
+    updated_at = Column(DateTime, nullable=False)
+
+
+class TVDB_Banner(Base):
+    __tablename__ = 'tvdb_banners'
+
+    # Columns
+    tvmaze_id = Column(Integer, primary_key=True)
+    tvdb_id = Column(Integer)  # validated TheTVDB id (TVmaze's is sometimes wrong)
+    banner_url = Column(String(200))  # None when TheTVDB has no banner for the show
+    refreshed_at = Column(DateTime, nullable=False)
+
+
+class Report_Delivery(Base):
+    __tablename__ = 'report_deliveries'
+
+    # Columns
+    slack_id = Column(String(30), primary_key=True)
+    report_date = Column(Date, primary_key=True)
+    delivered_at = Column(DateTime, nullable=False)
+
+
+class Series_Catalog(Base):
+    __tablename__ = 'series_catalog'
+
+    # Columns
+    id = Column(Integer, primary_key=True)  # a new row per update; only the latest is kept
+    format_version = Column(Integer, nullable=False)
+    last_page = Column(Integer, nullable=False)  # last page of TVmaze's /shows index holding shows
+    show_count = Column(Integer, nullable=False)
+    rows = Column(LargeBinary, nullable=False)  # JSON list of (id, name, year, weight, updated)
+    created_at = Column(DateTime, nullable=False)
+
+
+# Connection pool settings (overridable per dyno through the environment)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+
+# One engine per process. Sessions are handed out per thread by the registry so
+# the gunicorn request threads and the background threads never share one.
+Session = scoped_session(sessionmaker())
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+pool_stats = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkins': 0,
+    'checkout_wait_seconds': 0.0,
+    'checkout_wait_max_seconds': 0.0,
+    'checkout_timeouts': 0
+}
+_pool_stats_lock = threading.Lock()
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records how long callers wait to check out a connection."""
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with _pool_stats_lock:
+                pool_stats['checkout_timeouts'] += 1
+            raise
+        finally:
+            waited = time.time() - start
+            with _pool_stats_lock:
+                pool_stats['checkout_wait_seconds'] += waited
+                if waited > pool_stats['checkout_wait_max_seconds']:
+                    pool_stats['checkout_wait_max_seconds'] = waited
+
+
+def _count_pool_event(stat):
+    def listener(*args):
+        with _pool_stats_lock:
+            pool_stats[stat] += 1
+    return listener
+
+
+def _start_connection_hold(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info['checked_out_at'] = time.time()
+
+
+def _end_connection_hold(dbapi_connection, connection_record):
+    # How long a session kept its connection checked out of the pool
+    checked_out_at = connection_record.info.pop('checked_out_at', None)
+    if checked_out_at is not None:
+        metrics.record_span('db_session', time.time() - checked_out_at, started_at=checked_out_at)
+
+
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started_at'] = time.time()
+
+
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    started_at = conn.info.pop('query_started_at', None)
+    if started_at is not None:
+        metrics.record_span('db_query', time.time() - started_at, started_at=started_at)
+
+
 def create_db_session():
 
-    engine = create_db_engine()
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    get_db_engine()
+    session = Session()
 
     return session
 
 
+def get_db_engine():
+    """
+    Return the engine for this process, creating it on first use.
+    A process forked from a parent that already opened the engine (gunicorn
+    workers, multiprocessing) gets a fresh engine instead of sharing sockets.
+    """
+    global _engine, _engine_pid
+
+    pid = os.getpid()
+    if _engine is not None and _engine_pid == pid:
+        return _engine
+
+    with _engine_lock:
+        if _engine is not None and _engine_pid != pid:
+            # Inherited from the parent: throw away its pool so this process
+            # opens its own connections.
+            _engine.dispose()
+            Session.remove()
+            _engine = None
+        if _engine is None:
+            _engine = create_db_engine()
+            _engine_pid = pid
+            Base.metadata.bind = _engine
+            Session.configure(bind=_engine)
+            ensure_schema(_engine)
+
+    return _engine
+
+
+def get_pool_status():
+
+    with _pool_stats_lock:
+        status = dict(pool_stats)
+    engine = _engine
+    if engine is not None and _engine_pid == os.getpid():
+        pool = engine.pool
+        status['size'] = pool.size()
+        status['checked_out'] = pool.checkedout()
+        status['overflow'] = pool.overflow()
+        status['checked_in'] = pool.checkedin()
+
+    return status
+
+
+_schema_checked = False
+
+
+def ensure_schema(engine):
+    """
+    Once per process, check the database is at the latest migration.
+    Migrations normally run in the release phase (python migrations.py upgrade);
+    set DB_AUTO_MIGRATE=1 to apply them here instead, e.g. for local development.
+    """
+    global _schema_checked
+
+    if _schema_checked:
+        return
+    _schema_checked = True
+
+    import migrations
+    if os.environ.get('DB_AUTO_MIGRATE') == '1':
+        migrations.upgrade(engine)
+    else:
+        pending = migrations.pending(engine)
+        if pending:
+            logger.warning('Database schema is behind by %d migration(s). Run: python migrations.py upgrade', len(pending))
+
+
 def create_db_engine():
     # Local URL: postgresql://localhost/jarvis
     database_url = os.environ['DATABASE_URL']
-    engine = create_engine(database_url)
+    engine = create_engine(
+        database_url,
+        poolclass=MeteredQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True
+    )
     # engine = create_engine('sqlite:///tvmaze.db')
 
-    return engine
-
+    event.listen(engine, 'connect', _count_pool_event('connects'))
+    event.listen(engine, 'checkout', _count_pool_event('checkouts'))
+    event.listen(engine, 'checkin', _count_pool_event('checkins'))
+    if metrics.ENABLED:
+        event.listen(engine, 'checkout', _start_connection_hold)
+        event.listen(engine, 'checkin', _end_connection_hold)
+        event.listen(engine, 'before_cursor_execute', _start_query)
+        event.listen(engine, 'after_cursor_execute', _end_query)
 
-# Create all tables in the engine. This is equivalent to "Create Table"
-# statements in raw SQL.
-engine = create_db_engine()
-Base.metadata.create_all(engine)
\ No newline at end of file
+    return engine
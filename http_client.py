@@ -0,0 +1,224 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+import requests
+import metrics
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+# setup logging
+logger = logging.getLogger('main.http_client')
+
+# Constants
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_CAP = 30.0
+DEFAULT_MAX_CONCURRENCY = 10
+
+# Simultaneous requests allowed per host; also the size of the host's keep-alive pool
+HOST_CONCURRENCY = {
+    'api.tvmaze.com': int(os.environ.get('TVMAZE_MAX_CONCURRENCY', 8)),
+    'api.thetvdb.com': int(os.environ.get('TVDB_MAX_CONCURRENCY', 8))
+}
+
+_hosts = {}
+_hosts_pid = None
+_hosts_lock = threading.Lock()
+
+
+class HostPool(object):
+    """Keep-alive session, concurrency cap and counters for one host"""
+
+    def __init__(self, host):
+        max_concurrency = HOST_CONCURRENCY.get(host, DEFAULT_MAX_CONCURRENCY)
+        self.host = host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.in_flight = {}  # coalescing key -> InFlight
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'errors': 0,
+            'coalesced': 0
+        }
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+
+class InFlight(object):
+    """A GET being sent by one thread on behalf of every caller that asked for the same URL"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def get_host_pool(host):
+
+    global _hosts, _hosts_pid
+
+    pid = os.getpid()
+    pool = _hosts.get(host) if _hosts_pid == pid else None
+    if pool is not None:
+        return pool
+
+    with _hosts_lock:
+        if _hosts_pid != pid:
+            # Sockets opened before a fork belong to the parent
+            _hosts = {}
+            _hosts_pid = pid
+        if host not in _hosts:
+            _hosts[host] = HostPool(host)
+
+    return _hosts[host]
+
+
+def host_stats(host=None):
+    """Request/retry/error counters, for one host or keyed by host"""
+
+    if host is not None:
+        pool = get_host_pool(host)
+        with pool.lock:
+            return dict(pool.stats)
+
+    with _hosts_lock:
+        pools = list(_hosts.values())
+    return {pool.host: host_stats(pool.host) for pool in pools}
+
+
+def endpoint_name(path):
+    """Collapse ids in a URL path so latencies group by endpoint: /shows/82 -> /shows/{id}"""
+
+    return re.sub(r'/(?:tt)?\d+(?=/|$)', '/{id}', path) or '/'
+
+
+def retry_delay(response, attempt):
+
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+
+    # Full jitter: spreads retries from many threads instead of bunching them up
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def coalescing_key(url, params, headers):
+
+    prepared = requests.Request('GET', url, params=params).prepare()
+    return prepared.url, tuple(sorted((headers or {}).items()))
+
+
+def request(method, url, retries=MAX_RETRIES, rate_limiter=None, timeout=None, coalesce=True, **kwargs):
+    """
+    Send a request through the host's pooled session.
+    Connection errors, timeouts and RETRY_STATUSES responses are retried with
+    jittered exponential backoff (or the server's Retry-After). The last
+    response is returned as-is, and the last connection error is re-raised.
+    `rate_limiter` is a TokenBucket acquired before every attempt and paused on 429s.
+    Concurrent GETs for the same URL are coalesced: one is sent and every caller
+    gets its response (or its error), unless `coalesce` is False.
+    """
+
+    parts = urlsplit(url)
+    endpoint = endpoint_name(parts.path)
+    with metrics.span('http', host=parts.netloc, endpoint=endpoint):
+        if method != 'GET' or not coalesce:
+            return _send(method, url, parts.netloc, endpoint, retries, rate_limiter, timeout, kwargs)
+
+        pool = get_host_pool(parts.netloc)
+        key = coalescing_key(url, kwargs.get('params'), kwargs.get('headers'))
+        with pool.lock:
+            call = pool.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = pool.in_flight[key] = InFlight()
+
+        if not leader:
+            call.done.wait()
+            pool.count('coalesced')
+            if call.error is not None:
+                raise call.error
+            return call.response
+
+        try:
+            call.response = _send(method, url, parts.netloc, endpoint, retries, rate_limiter, timeout, kwargs)
+            # Read the body now; the followers share this response object
+            call.response.content
+            return call.response
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with pool.lock:
+                del pool.in_flight[key]
+            call.done.set()
+
+
+def _send(method, url, host, endpoint, retries, rate_limiter, timeout, kwargs):
+
+    pool = get_host_pool(host)
+    latency = metrics.histogram('http_request_seconds', {
+        'host': host,
+        'endpoint': endpoint
+    })
+    timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+    for attempt in range(retries + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+
+        response = None
+        error = None
+        start = time.time()
+        with pool.slots:
+            try:
+                response = pool.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+        latency.observe(time.time() - start)
+        pool.count('requests')
+
+        if error is None and response.status_code not in RETRY_STATUSES:
+            return response
+        if attempt == retries:
+            break
+
+        delay = retry_delay(response, attempt)
+        logger.warning("%s %s failed (%s). Retrying in %.1fs",
+                       method, url, error or response.status_code, delay)
+        pool.count('retries')
+        if rate_limiter and response is not None and response.status_code == 429:
+            rate_limiter.pause(delay)
+        else:
+            time.sleep(delay)
+
+    pool.count('errors')
+    if error is not None:
+        raise error
+
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
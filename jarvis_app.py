@@ -1,30 +1,87 @@
+import os
 import re
 import logging
+import log_setup
+import json_codec
 import tvmaze
 import thetvdb
-from threading import Thread
-from slack import post_message, delete_message, post_dialog, post_file
+import series_index
+import bulk_watchlist
+import jobs
+import metrics
+import http_client
+from concurrent.futures import ThreadPoolExecutor, wait
+from slack import post_message, post_response, delete_message, post_dialog, post_file
+from db_schema import Session, get_pool_status
 from datetime import datetime, date
-from flask import Flask, request, Response, jsonify, json
+from flask import Flask, request, Response
 
 app = Flask(__name__)
 
+# Sent when the background queue is full and a request's job was dropped
+BUSY_TEXT = "_Jarvis is busy right now. Please try again in a minute._"
+
+# Series cards
+CARD_EMBEDS = ('previousepisode', 'nextepisode')
+CARD_DEADLINE = float(os.environ.get('CARD_DEADLINE_SECONDS', 2.5))
+card_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('CARD_LOOKUP_WORKERS', 8)))
+
 
 # setup logging
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = log_setup.configure_logging('jarvis_app.log')
+
+
+@app.before_first_request
+def warm_series_index():
+    # Runs in each worker after the fork, so the master never opens a database
+    # connection. get_index() doesn't block: the index loads on a background thread.
+    series_index.get_index()
+
+
+@app.before_request
+def start_request_trace():
+    if request.endpoint != 'prometheus_metrics':
+        # Unmatched paths share one label, so scanners probing for URLs can't create new series
+        metrics.start_trace(request.endpoint or 'unmatched')
+
+
+def json_response(payload):
 
-fh = logging.FileHandler('jarvis_app.log')
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
+    return Response(json_codec.dumps(payload), mimetype='application/json')
 
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(formatter)
 
-logger = logging.getLogger('main')
-logger.setLevel(logging.DEBUG)
-logger.addHandler(fh)
-logger.addHandler(ch)
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    # Hand the request thread's session back to the pool, then close the trace
+    # so it includes the time the connection was held
+    Session.remove()
+    metrics.end_trace()
+
+
+def collect_stats():
+    """Samples for /metrics from the cache, job queue, HTTP host and DB pool counters"""
+
+    samples = metrics.stats_samples(
+        'tvmaze_cache', tvmaze.response_cache.stats(),
+        counters=('hits', 'misses', 'evictions', 'expirations', 'invalidations'))
+    samples += metrics.stats_samples(
+        'tvmaze_search_cache', tvmaze.search_cache.stats(),
+        counters=('hits', 'prefix_hits', 'misses', 'saved_calls', 'evictions', 'expirations'))
+    for executor in (jobs.background, jobs.bulk):
+        samples += metrics.stats_samples(
+            'jobs', executor.stats(), {'executor': executor.name},
+            counters=('submitted', 'rejected', 'completed', 'failed'))
+    for host, host_stats in http_client.host_stats().items():
+        samples += metrics.stats_samples('http_host', host_stats, {'host': host}, counters=('requests', 'retries', 'errors', 'coalesced'))
+    samples += metrics.stats_samples(
+        'db_pool', get_pool_status(),
+        counters=('connects', 'checkouts', 'checkins', 'checkout_wait_seconds', 'checkout_timeouts'))
+    samples.append(('log_records_dropped_total', 'counter', None, log_setup.DroppingQueueHandler.dropped))
+
+    return samples
+
+
+metrics.register_collector(collect_stats)
 
 
 @app.route('/tv', methods=['POST'])
@@ -33,7 +90,7 @@ def create_search_box(channel_id=None, slack_id=None):
     logger.info("Creating search box")
     
     try:
-        logger.debug("Request form: \n{}".format(request.form))
+        logger.debug("Request form: \n%s", log_setup.truncate(request.form))
     except:
         pass
 
@@ -60,21 +117,27 @@ def create_search_box(channel_id=None, slack_id=None):
             "response_type": "ephemeral",
             "blocks": blocks
         }
-        return jsonify(payload)
+        return json_response(payload)
 
 
 def respond_to_series_request(series_id, channel_id, user_name, slack_id):
 
-    series_data = tvmaze.get_series_data_via_id(series_id)
+    series_data = tvmaze.get_series_data_via_id(series_id, embed=CARD_EMBEDS)
     blocks = format_series_output(series_data, user_name)
     post_message(blocks, channel_id=channel_id)
     create_search_box(channel_id, slack_id)
 
 
+@metrics.timed('render', block='series_card')
 def format_series_output(series_data, user_name):
+    """
+    Build the Block Kit card for a series.
+    The banner and any episodes not embedded in series_data are looked up in parallel;
+    whatever hasn't arrived by CARD_DEADLINE is left out of the card.
+    """
 
     series_name = series_data['name']
-    logger.info("Formatting series output for {}".format(series_name))
+    logger.info("Formatting series output for %s", series_name)
     series_id = series_data['id']
 
     series_status = series_data['status']
@@ -86,11 +149,35 @@ def format_series_output(series_data, user_name):
         series_description += " (<{}|IMDB>)".format(imdb_url)
 
     tvdb_series_id = series_data['externals']['thetvdb']
-    if not thetvdb.validate_series_id(tvdb_series_id):
-        tvdb_series_id = thetvdb.find_series_id_via_imdb(imdb_id)
-    image_url = thetvdb.get_series_banner(tvdb_series_id)
+    lookups = {
+        'banner': card_executor.submit(metrics.bind_trace(thetvdb.find_series_banner), series_id, tvdb_series_id, imdb_id)
+    }
+    embedded = series_data.get('_embedded', {})
+    for episode_key in CARD_EMBEDS:
+        if episode_key in embedded:
+            continue
+        episode_link = series_data['_links'].get(episode_key)
+        if episode_link:
+            lookups[episode_key] = card_executor.submit(metrics.bind_trace(tvmaze.get_episode_data), episode_link['href'])
+
+    done, not_done = wait(lookups.values(), timeout=CARD_DEADLINE)
+    if not_done:
+        logger.warning("Card deadline hit for %s. Rendering without %s", series_name,
+                       [key for key, future in lookups.items() if future in not_done])
+
+    def lookup_result(key):
+        future = lookups.get(key)
+        if future is None or future not in done:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.error("Lookup '%s' failed for %s: %s", key, series_name, e)
+            return None
+
+    image_url = lookup_result('banner')
     if not image_url:
-        image_url = series_data["image"]["original"]
+        image_url = (series_data.get("image") or {}).get("original")
         # image_url = series_data["image"]["medium"]
 
     if series_data.get("network"):
@@ -100,16 +187,14 @@ def format_series_output(series_data, user_name):
     else:
         network_name = 'Unlisted Network'
 
-    try:
-        previous_episode_url = series_data['_links']['previousepisode']['href']
-        previous_episode_output = format_episode_output(previous_episode_url)
-    except:
+    previous_episode = embedded.get('previousepisode') or lookup_result('previousepisode')
+    previous_episode_output = format_episode_output(previous_episode) if previous_episode else None
+    if not previous_episode_output:
         previous_episode_output = 'None'
-    
-    try:
-        next_episode_url = series_data['_links']['nextepisode']['href']
-        next_episode_output = format_episode_output(next_episode_url)
-    except:
+
+    next_episode = embedded.get('nextepisode') or lookup_result('nextepisode')
+    next_episode_output = format_episode_output(next_episode) if next_episode else None
+    if not next_episode_output:
         if series_status == 'Ended':
             next_episode_output = 'Discontinued'
         else:
@@ -193,7 +278,10 @@ def format_series_output(series_data, user_name):
         }
     ]
 
-    logger.info('Finished formatting output for {}'.format(series_name))
+    if not image_url:
+        blocks.pop(0)
+
+    logger.info('Finished formatting output for %s', series_name)
 
     return blocks
 
@@ -204,15 +292,18 @@ def remove_html_tags(text):
     return re.sub(pattern, "", text)
 
 
-def format_episode_output(episode_url):
+def format_episode_output(episode_data):
 
-    episode_data = tvmaze.get_episode_data(episode_url)
     season_number = str(episode_data.get('season'))
     episode_number = str(episode_data.get('number'))
     episode_date = episode_data.get('airdate')
 
     date_format = '%Y-%m-%d'
-    episode_date_object = datetime.strptime(episode_date, date_format)
+    try:
+        episode_date_object = datetime.strptime(episode_date, date_format)
+    except (TypeError, ValueError):
+        # Episode announced without an airdate
+        return None
     today = datetime.combine(date.today(), datetime.min.time())
     
     delta_days = (episode_date_object - today).days
@@ -244,27 +335,66 @@ def create_watchlist_report():
     payload = tvmaze.create_watchlist_output(slack_id, slack_name, channel_id)
 
     if payload:
-        return jsonify(payload)
+        return json_response(payload)
     else:
         return ""
 
 
+@app.route('/watchlist-import', methods=['POST'])
+def import_watchlist():
+
+    req = request.form
+    entries = bulk_watchlist.parse_entries(req.get('text'))
+    if not entries:
+        return json_response(ephemeral_text(
+            "List the shows to follow, one per line: a title, `tvmaze:<id>` or an IMDB id like `tt0903747`."))
+
+    # Resolving a few hundred shows takes far longer than Slack's 3 second deadline
+    if not submit_job(bulk_watchlist.import_watchlist, req.get('text'), req['user_id'], req['user_name'], req['channel_id'],
+                      executor=jobs.bulk):
+        return json_response(ephemeral_text(BUSY_TEXT))
+
+    return json_response(ephemeral_text("_Importing {} show(s). I'll keep you posted._".format(len(entries))))
+
+
+@app.route('/watchlist-export', methods=['POST'])
+def export_watchlist():
+
+    req = request.form
+    if not submit_job(bulk_watchlist.export_watchlist, req['user_id'], req['user_name'], req['channel_id'],
+                      executor=jobs.bulk):
+        return json_response(ephemeral_text(BUSY_TEXT))
+
+    return json_response(ephemeral_text("_Exporting your watchlist. It'll arrive as a file in our DM._"))
+
+
+def ephemeral_text(text):
+
+    return {
+        "response_type": "ephemeral",
+        "text": text
+    }
+
+
 @app.route('/series-search', methods=['POST'])
 def series_search():
 
-    req = json.loads(request.form.get('payload'))
+    req = json_codec.loads(request.form.get('payload'))
     text = req.get('value')
-    logger.info("User search request for '{}' has been received.".format(text))
-    payload = tvmaze.search_for_series(text)
+    logger.info("User search request for '%s' has been received.", text)
+    payload = series_index.search_options(text)
+    if payload is None:
+        # No local index yet, or a show newer than the last catalog update
+        payload = tvmaze.search_for_series(text)
 
-    return jsonify(payload)
+    return json_response(payload)
 
 
 @app.route('/spoiler', methods=['POST'])
 def create_spoiler_dialog():
 
     req = request.form
-    logger.debug("/spoiler request received:\n{}".format(req))
+    logger.debug("/spoiler request received:\n%s", log_setup.truncate(req))
     trigger_id = req["trigger_id"]
 
     ### Switch this to an dialog.open API call
@@ -327,8 +457,8 @@ def create_spoiler_dialog():
 def inbound():
 
     logger.info("Inbound request from user received.")
-    req = json.loads(request.form.get('payload'))
-    logger.debug('Request data: \n{}'.format(req))
+    req = json_codec.loads(request.form.get('payload'))
+    logger.debug('Request data: \n%s', log_setup.truncate(req))
 
     user_name = req['user']['name']
     slack_id = req['user']['id']
@@ -336,41 +466,68 @@ def inbound():
     callback_id = req.get('callback_id')
     action = req.get('actions')
 
+    # Slack wants an ack within 3 seconds, so anything slow runs on the background executor
+    submitted = True
     if action:
         action_id = action[0]['action_id']
 
         if action_id == 'series_search':
             series_id = action[0]['selected_option']['value']
             logger.info("Inbound request is a 'series_search'")
-            t = Thread(target=respond_to_series_request, args=(
-                series_id, channel_id, user_name, slack_id))
-            logger.info("Starting thread to generate series output")
-            t.start()
+            submitted = submit_job(respond_to_series_request, series_id, channel_id, user_name, slack_id)
             # delete_message(channel_id, message_ts)
 
         elif action_id == "add_to_watchlist":
             series_id = action[0]["value"]
-            output_text = tvmaze.add_series_to_watchlist(series_id, slack_id, user_name)
-            blocks = format_response_blocks(output_text)
-            post_message(blocks, channel_id=channel_id, slack_id=slack_id, ephemeral=True)
+            submitted = submit_job(respond_to_add_to_watchlist, series_id, channel_id, user_name, slack_id)
 
         elif action_id == "remove_from_watchlist":
             series_id = action[0]["value"]
-            output_text = tvmaze.remove_series_from_watchlist(series_id, slack_id)
-            blocks = format_response_blocks(output_text)
-            post_message(blocks, channel_id=channel_id, slack_id=slack_id, ephemeral=True)
+            submitted = submit_job(respond_to_remove_from_watchlist, series_id, channel_id, slack_id)
 
     if callback_id:
         if callback_id == "create_spoiler":
             subject = req['submission']['spoiler_subject']
             body = req['submission']['spoiler_body']
             title, content = format_spoiler_output(subject, body, user_name)
-            post_file(channel_id, content, title)
+            submitted = submit_job(post_file, channel_id, content, title)
+
+    if not submitted:
+        # The job was dropped, so nothing else would ever reach the user. Posted to the
+        # response_url with a short timeout, since this happens when the server is busiest
+        # and Slack still needs its ack.
+        response_url = req.get('response_url')
+        if response_url:
+            post_response(response_url, BUSY_TEXT)
 
     logger.info('Sending HTTP Status 200 to requesting server')
     return '', 200
 
 
+def submit_job(fn, *args, executor=None):
+    """Run fn(*args) on `executor` (default: jobs.background). Returns False if the queue was full and the job dropped."""
+
+    submitted = (executor or jobs.background).submit(fn, *args)
+    if not submitted:
+        logger.error("Server is overloaded. Dropped '%s' request", fn.__name__)
+
+    return submitted
+
+
+def respond_to_add_to_watchlist(series_id, channel_id, user_name, slack_id):
+
+    output_text = tvmaze.add_series_to_watchlist(series_id, slack_id, user_name)
+    blocks = format_response_blocks(output_text)
+    post_message(blocks, channel_id=channel_id, slack_id=slack_id, ephemeral=True)
+
+
+def respond_to_remove_from_watchlist(series_id, channel_id, slack_id):
+
+    output_text = tvmaze.remove_series_from_watchlist(series_id, slack_id)
+    blocks = format_response_blocks(output_text)
+    post_message(blocks, channel_id=channel_id, slack_id=slack_id, ephemeral=True)
+
+
 def format_response_blocks(text):
 
     blocks = [
@@ -399,6 +556,29 @@ def test():
     return Response('Nothing to see here. Move along!')
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+
+    payload = {
+        'tvmaze_cache': tvmaze.response_cache.stats(),
+        'tvmaze_search_cache': tvmaze.search_cache.stats(),
+        'background_jobs': jobs.background.stats(),
+        'bulk_jobs': jobs.bulk.stats(),
+        'http_hosts': http_client.host_stats(),
+        'db_pool': get_pool_status(),
+        'histograms': metrics.snapshot(),
+        'slow_traces': list(metrics.recent_traces)
+    }
+
+    return json_response(payload)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == "__main__":
     app.run()
 
@@ -438,10 +618,6 @@ if __name__ == "__main__":
 
 # BEYOND 1.0 ROADMAP
 
-# Perform internal fuzzy searches (rather than API calls)
-    # Update list of TV shows through daily pull
-    # Do fuzzy searches against that
-
 # Usage tracking
     # How often commands are used and by how many users
 
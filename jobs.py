@@ -0,0 +1,142 @@
+import os
+import time
+import queue
+import logging
+import threading
+import metrics
+from db_schema import Session
+
+# setup logging
+logger = logging.getLogger('main.jobs')
+
+OVERLOAD_POLICIES = ('reject', 'block')
+
+
+class JobExecutor(object):
+    """
+    Fixed pool of worker threads fed from a bounded queue.
+    When the queue is full, the 'reject' policy drops the job immediately and
+    'block' waits up to `block_timeout` seconds for room before dropping it.
+    Workers are started on first submit, so a pre-forking server that imports
+    this module in its master process doesn't leave threads behind in workers.
+    """
+
+    def __init__(self, name, workers, max_queue, overload_policy='reject', block_timeout=0.5):
+        if overload_policy not in OVERLOAD_POLICIES:
+            raise ValueError('Unknown overload policy: {}'.format(overload_policy))
+
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overload_policy = overload_policy
+        self.block_timeout = block_timeout
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'rejected': 0,
+            'completed': 0,
+            'failed': 0
+        }
+        self.queue_wait = metrics.histogram('job_queue_wait_seconds', {'executor': name})
+        self.duration = metrics.histogram('job_duration_seconds', {'executor': name})
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs). Returns False if the job was dropped."""
+
+        job_queue = self._ensure_started()
+        # Remember the submitting request's trace, so the job's trace can point back to it
+        parent = metrics.current_trace()
+        job = (time.time(), parent.id if parent else None, fn, args, kwargs)
+        try:
+            if self.overload_policy == 'block':
+                job_queue.put(job, timeout=self.block_timeout)
+            else:
+                job_queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            logger.warning("Job queue '%s' is full. Dropping %s", self.name, getattr(fn, '__name__', fn))
+            return False
+
+        with self._lock:
+            self._stats['submitted'] += 1
+
+        return True
+
+    def join(self):
+        """Block until every job queued so far has finished"""
+
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def stats(self):
+
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize() if self._queue is not None else 0
+        stats['workers'] = self.workers
+        stats['max_queue'] = self.max_queue
+
+        return stats
+
+    def _ensure_started(self):
+
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._queue
+
+        with self._lock:
+            if self._pid != pid:
+                # First use in this process (threads don't survive a fork)
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                for i in range(self.workers):
+                    t = threading.Thread(
+                        target=self._work,
+                        args=(self._queue,),
+                        name='{}-worker-{}'.format(self.name, i)
+                    )
+                    t.daemon = True
+                    t.start()
+                self._pid = pid
+
+        return self._queue
+
+    def _work(self, job_queue):
+
+        while True:
+            enqueued_at, parent_id, fn, args, kwargs = job_queue.get()
+            started_at = time.time()
+            self.queue_wait.observe(started_at - enqueued_at)
+            metrics.start_trace('job:{}'.format(getattr(fn, '__name__', fn)), parent_id)
+            try:
+                fn(*args, **kwargs)
+                outcome = 'completed'
+            except Exception:
+                logger.exception("Job %s failed in '%s'", getattr(fn, '__name__', fn), self.name)
+                outcome = 'failed'
+            finally:
+                # Worker threads are reused, so don't let a job's DB session leak into the next
+                Session.remove()
+                metrics.end_trace()
+                self.duration.observe(time.time() - started_at)
+                job_queue.task_done()
+            with self._lock:
+                self._stats[outcome] += 1
+
+
+# Shared executor for work that mustn't hold up a response to Slack
+background = JobExecutor(
+    'background',
+    workers=int(os.environ.get('JOB_WORKERS', 8)),
+    max_queue=int(os.environ.get('JOB_QUEUE_SIZE', 200)),
+    overload_policy=os.environ.get('JOB_OVERLOAD_POLICY', 'reject')
+)
+# Bulk imports and exports, kept apart so a few minutes-long imports (paced by
+# TVmaze's rate limit) can't take the workers that answer button clicks
+bulk = JobExecutor(
+    'bulk',
+    workers=int(os.environ.get('BULK_JOB_WORKERS', 2)),
+    max_queue=int(os.environ.get('BULK_JOB_QUEUE_SIZE', 20))
+)
@@ -0,0 +1,81 @@
+"""
+The app's one JSON encoder/decoder.
+Uses orjson or ujson when installed (JSON_BACKEND picks one explicitly), else the
+standard library. Output is compact UTF-8 text whichever backend is in use.
+"""
+import os
+import json
+import logging
+
+# setup logging
+logger = logging.getLogger('main.json_codec')
+
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')  # auto, orjson, ujson or json
+
+
+def _orjson_backend():
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def encode(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    return 'orjson', loads, encode
+
+
+def _ujson_backend():
+    import ujson
+
+    def loads(data):
+        return ujson.loads(data)
+
+    def encode(obj):
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+    return 'ujson', loads, encode
+
+
+def _json_backend():
+
+    def loads(data):
+        return json.loads(data)
+
+    def encode(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+    return 'json', loads, encode
+
+
+def _load_backend(name):
+
+    candidates = {
+        'orjson': (_orjson_backend,),
+        'ujson': (_ujson_backend,),
+        'json': (_json_backend,)
+    }.get(name, (_orjson_backend, _ujson_backend, _json_backend))
+
+    for candidate in candidates:
+        try:
+            return candidate()
+        except ImportError:
+            continue
+
+    logger.warning("JSON backend '%s' is not installed. Using the standard library", name)
+    return _json_backend()
+
+
+backend, _loads, _encode = _load_backend(JSON_BACKEND)
+
+
+def loads(data):
+    """Decode a JSON document from str or bytes (e.g. response.content, skipping requests' charset detection)"""
+
+    return _loads(data)
+
+
+def dumps(obj):
+    """Encode obj as compact JSON text"""
+
+    return _encode(obj)
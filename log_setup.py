@@ -0,0 +1,137 @@
+import os
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Per-module overrides, e.g. LOG_LEVELS="main.tvmaze=DEBUG,main.slack=WARNING"
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_PAYLOAD_CHARS = int(os.environ.get('LOG_PAYLOAD_CHARS', 500))
+
+_queue_handler = None
+_listener = None
+_handlers = ()
+_log_file = None
+
+
+class Truncated(object):
+    """
+    A payload to log as an argument: logger.debug('Series data: %s', truncate(data)).
+    It is only turned into a string, and cut to `limit` characters, if the record
+    is actually emitted.
+    """
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = str(self.value)
+        if len(text) <= self.limit:
+            return text
+        return '{}... ({} chars)'.format(text[:self.limit], len(text))
+
+
+def truncate(value, limit=None):
+    return Truncated(value, limit or LOG_PAYLOAD_CHARS)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the listener thread, dropping them if the queue is full rather than blocking"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def parse_levels(spec):
+
+    levels = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        levels[name.strip()] = level.strip().upper()
+
+    return levels
+
+
+def process_log_file(log_file, pid=None):
+    """The log file for a forked process: jarvis_app.log -> jarvis_app.<pid>.log"""
+
+    root, ext = os.path.splitext(log_file)
+    return '{}.{}{}'.format(root, pid or os.getpid(), ext)
+
+
+def rotating_file_handler(log_file):
+
+    fh = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True)
+    fh.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    return fh
+
+
+def configure_logging(log_file, logger_name='main'):
+    """
+    Send `logger_name` and its children through a bounded queue to a listener
+    thread that writes to the console and a size-rotated `log_file`, so the
+    threads doing the logging never wait on disk I/O.
+    Processes forked after this (gunicorn --preload workers) each write and
+    rotate their own process_log_file() instead.
+    """
+    global _queue_handler, _handlers, _log_file
+
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    _log_file = log_file
+    _handlers = (rotating_file_handler(log_file), ch)
+    _queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(LOG_LEVEL.upper())
+    logger.addHandler(_queue_handler)
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _start_listener()
+    atexit.register(_stop_listener)
+    if hasattr(os, 'register_at_fork'):
+        # The listener thread doesn't survive a fork (gunicorn --preload workers)
+        os.register_at_fork(after_in_child=_restart_in_child)
+
+    return logger
+
+
+def _start_listener():
+    global _listener
+
+    _listener = QueueListener(_queue_handler.queue, *_handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener():
+
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _restart_in_child():
+    global _handlers
+
+    # Processes rotating one shared file would rename it out from under each other
+    _, ch = _handlers
+    _handlers = (rotating_file_handler(process_log_file(_log_file)), ch)
+    _queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _start_listener()
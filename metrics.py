@@ -0,0 +1,319 @@
+import os
+import time
+import logging
+import threading
+import itertools
+from collections import deque
+from functools import wraps
+
+# setup logging
+logger = logging.getLogger('main.metrics')
+
+# METRICS_ENABLED=0 turns spans and traces into no-ops; the counters behind /metrics stay on
+ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+SLOW_TRACE_SECONDS = float(os.environ.get('SLOW_TRACE_SECONDS', 2.0))
+RECENT_TRACES = 50  # slow traces kept for /stats
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """Thread-safe cumulative histogram in the Prometheus style"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # the last slot is +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        """Return count, sum and cumulative bucket counts keyed by upper bound"""
+
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+            count = self._count
+
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+
+        return {
+            'count': count,
+            'sum': round(total, 6),
+            'buckets': cumulative
+        }
+
+
+_histograms = {}  # (name, labels) -> Histogram
+_histograms_lock = threading.Lock()
+
+
+def histogram(name, labels=None, buckets=DEFAULT_BUCKETS):
+    """Return the histogram for `name` and `labels` (a dict), creating it on first use"""
+
+    key = (name, tuple(sorted(labels.items())) if labels else ())
+    found = _histograms.get(key)
+    if found is not None:
+        return found
+    with _histograms_lock:
+        return _histograms.setdefault(key, Histogram(buckets))
+
+
+def series_name(name, labels):
+
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, v) for k, v in labels))
+
+
+def snapshot():
+
+    with _histograms_lock:
+        histograms = dict(_histograms)
+
+    return {series_name(name, labels): h.snapshot() for (name, labels), h in sorted(histograms.items())}
+
+
+class Trace(object):
+    """The spans recorded while handling one inbound request or background job"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name, parent_id=None):
+        self.id = next(Trace._ids)
+        self.name = name
+        self.parent_id = parent_id
+        self.started_at = time.time()
+        self.duration = None
+        self.spans = []  # (name, labels, offset, duration), appended from any thread
+        self._lock = threading.Lock()
+
+    def add(self, name, labels, started_at, duration):
+
+        with self._lock:
+            self.spans.append((name, labels, round(started_at - self.started_at, 6), round(duration, 6)))
+
+    def summary(self):
+
+        with self._lock:
+            spans = list(self.spans)
+
+        return {
+            'id': self.id,
+            'name': self.name,
+            'parent_id': self.parent_id,
+            'duration': round(self.duration or 0.0, 6),
+            'spans': [
+                {'name': series_name(name, labels), 'offset': offset, 'duration': duration}
+                for name, labels, offset, duration in spans
+            ]
+        }
+
+
+_local = threading.local()
+recent_traces = deque(maxlen=RECENT_TRACES)
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def start_trace(name, parent_id=None):
+    """Start a trace on this thread. Spans recorded on the thread are attached to it."""
+
+    if not ENABLED:
+        return None
+    _local.trace = Trace(name, parent_id)
+    return _local.trace
+
+
+def end_trace():
+    """Close this thread's trace, record its duration and keep it if it was slow"""
+
+    trace = current_trace()
+    if trace is None:
+        return None
+    _local.trace = None
+
+    trace.duration = time.time() - trace.started_at
+    histogram('trace_seconds', {'trace': trace.name}).observe(trace.duration)
+    if trace.duration >= SLOW_TRACE_SECONDS:
+        summary = trace.summary()
+        recent_traces.append(summary)
+        logger.warning('Slow %s (trace %d, parent %s) took %.3fs: %s', trace.name, trace.id, trace.parent_id,
+                       trace.duration, ', '.join('{name} {duration:.3f}s'.format(**s) for s in summary['spans']))
+
+    return trace
+
+
+class _Span(object):
+
+    __slots__ = ('name', 'labels', 'started_at')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_span(self.name, time.time() - self.started_at, self.labels, self.started_at)
+        return False
+
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def span(name, **labels):
+    """
+    Time a block: `with metrics.span('slack', method='chat.postMessage'):`
+    The duration goes into the span_seconds histogram and onto the thread's trace.
+    """
+
+    if not ENABLED:
+        return _no_span
+    return _Span(name, labels)
+
+
+def record_span(name, duration, labels=None, started_at=None):
+    """Record a span that was timed elsewhere (e.g. by a SQLAlchemy event)"""
+
+    if not ENABLED:
+        return
+    histogram('span_seconds', dict(labels or {}, span=name)).observe(duration)
+    trace = current_trace()
+    if trace is not None:
+        trace.add(name, tuple(sorted((labels or {}).items())), started_at or time.time() - duration, duration)
+
+
+def timed(name, **labels):
+    """Decorator form of span()"""
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind_trace(fn):
+    """Wrap fn so that, run on another thread, its spans land on the caller's trace"""
+
+    trace = current_trace()
+    if trace is None:
+        return fn
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        previous = current_trace()
+        _local.trace = trace
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.trace = previous
+    return wrapper
+
+
+_collectors = []
+
+
+def register_collector(collect):
+    """
+    Add a callable that returns [(name, type, labels, value)] samples, e.g. pool
+    or cache counters, to be read each time /metrics is rendered.
+    """
+
+    _collectors.append(collect)
+
+
+def stats_samples(prefix, stats, labels=None, counters=()):
+    """Turn a stats dict into samples: keys in `counters` become counters, other numbers gauges"""
+
+    samples = []
+    for key, value in sorted(stats.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        if key in counters:
+            samples.append(('{}_{}_total'.format(prefix, key), 'counter', labels, value))
+        else:
+            samples.append(('{}_{}'.format(prefix, key), 'gauge', labels, value))
+
+    return samples
+
+
+def format_labels(labels, extra=()):
+
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs))
+
+
+def format_bound(bound):
+
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def render():
+    """Every histogram and collected sample in the Prometheus text exposition format"""
+
+    lines = []
+    typed = set()
+
+    with _histograms_lock:
+        histograms = dict(_histograms)
+    for (name, labels), h in sorted(histograms.items()):
+        if name not in typed:
+            lines.append('# TYPE {} histogram'.format(name))
+            typed.add(name)
+        snap = h.snapshot()
+        for bound, count in snap['buckets']:
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', format_bound(bound))]), count))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), snap['sum']))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), snap['count']))
+
+    samples = []
+    for collect in _collectors:
+        try:
+            samples.extend(collect())
+        except Exception:
+            logger.exception('Metrics collector %s failed', getattr(collect, '__name__', collect))
+    for name, metric_type, labels, value in sorted(samples, key=lambda s: (s[0], sorted((s[2] or {}).items()))):
+        if name not in typed:
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            typed.add(name)
+        lines.append('{}{} {}'.format(name, format_labels(sorted((labels or {}).items())), value))
+
+    return '\n'.join(lines) + '\n'
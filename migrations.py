@@ -0,0 +1,323 @@
+import sys
+import logging
+import argparse
+from datetime import datetime
+from sqlalchemy import MetaData, Table, Column, ForeignKey, Integer, String, Boolean, Date, DateTime, LargeBinary, select
+from sqlalchemy.types import JSON
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session as OrmSession
+from db_schema import get_db_engine, create_db_engine
+
+# setup logging
+logger = logging.getLogger('main.migrations')
+
+# Bookkeeping lives outside Base.metadata so create_all() never touches it
+migration_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', migration_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200)),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+# Arbitrary key for pg_advisory_xact_lock, so concurrent upgrades run one at a time
+MIGRATION_LOCK_ID = 4242017
+
+# The tables as the released migrations left them. Migrations only ever use these
+# snapshots, never the models in db_schema, so later changes to the models can't
+# change what a released migration does.
+released_metadata = MetaData()
+users = Table(
+    'users', released_metadata,
+    Column('id', Integer, primary_key=True, unique=True),
+    Column('slack_id', String(30), unique=True, nullable=False),
+    Column('slack_name', String(30), unique=True, nullable=False),
+    Column('Receive Notifications', Boolean),
+    Column('dm_channel_id', String(30))
+)
+tv_series = Table(
+    'tv_series', released_metadata,
+    Column('id', Integer, primary_key=True, unique=True),
+    Column('tvmaze_id', Integer, unique=True, nullable=False),
+    Column('name', String(100)),
+    Column('status', String(20)),
+    Column('api_url', String(100)),
+    Column('next_episode_season', Integer),
+    Column('next_episode_number', Integer),
+    Column('next_episode_name', String(50)),
+    Column('next_episode_date', Date),
+    Column('next_episode_api_url', String(100)),
+    Column('updated', Integer)
+)
+follows = Table(
+    'users_following_tv_series', released_metadata,
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('tv_series_id', Integer, ForeignKey('tv_series.id'), primary_key=True),
+    Column('is_following', Boolean)
+)
+tvdb_banners = Table(
+    'tvdb_banners', released_metadata,
+    Column('tvmaze_id', Integer, primary_key=True),
+    Column('tvdb_id', Integer),
+    Column('banner_url', String(200)),
+    Column('refreshed_at', DateTime, nullable=False)
+)
+report_deliveries = Table(
+    'report_deliveries', released_metadata,
+    Column('slack_id', String(30), primary_key=True),
+    Column('report_date', Date, primary_key=True),
+    Column('delivered_at', DateTime, nullable=False)
+)
+watchlist_summaries = Table(
+    'watchlist_summaries', released_metadata,
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True),
+    Column('items', JSON, nullable=False),
+    Column('updated_at', DateTime, nullable=False)
+)
+series_catalog = Table(
+    'series_catalog', released_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('format_version', Integer, nullable=False),
+    Column('last_page', Integer, nullable=False),
+    Column('show_count', Integer, nullable=False),
+    Column('rows', LargeBinary, nullable=False),
+    Column('created_at', DateTime, nullable=False)
+)
+
+# Only active follows are ever looked up, so the follow indexes skip the rest
+RELEASED_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_follows_user_following '
+    'ON users_following_tv_series (user_id, tv_series_id) WHERE is_following',
+    'CREATE INDEX IF NOT EXISTS ix_follows_series_following '
+    'ON users_following_tv_series (tv_series_id, user_id) WHERE is_following',
+]
+ACTIVE_FOLLOW_INDEXES = ('ix_follows_user_following', 'ix_follows_series_following')
+
+
+def create_tables(connection):
+    # Tables that already exist are left alone
+    released_metadata.create_all(connection, tables=[users, tv_series, follows, tvdb_banners, report_deliveries])
+
+
+def add_refresh_and_dm_columns(connection):
+
+    connection.execute('ALTER TABLE tv_series ADD COLUMN IF NOT EXISTS updated INTEGER')
+    connection.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS dm_channel_id VARCHAR(30)')
+
+
+def create_indexes(connection):
+
+    for statement in RELEASED_INDEXES:
+        connection.execute(statement)
+
+
+def create_watchlist_summaries(connection):
+
+    watchlist_summaries.create(connection, checkfirst=True)
+
+    items = {row.id: [] for row in connection.execute(select([users.c.id]))}
+    followed = select([follows.c.user_id, tv_series.c.id, tv_series.c.name, tv_series.c.status]). \
+        select_from(follows.join(tv_series, tv_series.c.id == follows.c.tv_series_id)). \
+        where(follows.c.is_following == True)
+    for row in connection.execute(followed):
+        items[row.user_id].append({'id': row.id, 'name': row.name, 'status': row.status})
+
+    connection.execute(watchlist_summaries.delete())
+    if items:
+        now = datetime.utcnow()
+        connection.execute(watchlist_summaries.insert(), [
+            {'user_id': user_id, 'items': sorted(user_items, key=lambda item: item['name']), 'updated_at': now}
+            for user_id, user_items in items.items()
+        ])
+    logger.info('Built watchlist summaries for %d users', len(items))
+
+
+def add_series_refreshed_at(connection):
+
+    connection.execute('ALTER TABLE tv_series ADD COLUMN IF NOT EXISTS refreshed_at TIMESTAMP')
+
+
+def create_series_catalog(connection):
+
+    series_catalog.create(connection, checkfirst=True)
+
+
+# (version, description, function) in the order they must be applied.
+# Never edit a released migration; add a new one instead.
+MIGRATIONS = [
+    (1, 'create tables', create_tables),
+    (2, 'add tv_series.updated and users.dm_channel_id', add_refresh_and_dm_columns),
+    (3, 'add indexes for watchlist and report queries', create_indexes),
+    (4, 'create and backfill watchlist_summaries', create_watchlist_summaries),
+    (5, 'add tv_series.refreshed_at', add_series_refreshed_at),
+    (6, 'create series_catalog', create_series_catalog),
+]
+
+
+def applied_versions(connection):
+
+    migration_metadata.create_all(connection)
+    return set(row[0] for row in connection.execute(schema_migrations.select().with_only_columns([schema_migrations.c.version])))
+
+
+def pending(engine=None):
+
+    engine = engine or get_db_engine()
+    with engine.connect() as connection:
+        applied = applied_versions(connection)
+
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+
+def upgrade(engine=None):
+    """Apply pending migrations in one transaction. Returns the versions applied."""
+
+    engine = engine or get_db_engine()
+    applied_now = []
+    with engine.begin() as connection:
+        connection.execute('SELECT pg_advisory_xact_lock({})'.format(MIGRATION_LOCK_ID))
+        applied = applied_versions(connection)
+        for version, description, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info('Applying migration %d: %s', version, description)
+            migrate(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version,
+                description=description,
+                applied_at=datetime.utcnow()
+            ))
+            applied_now.append(version)
+
+    logger.info('Database schema is up to date (%d migration(s) applied)', len(applied_now))
+
+    return applied_now
+
+
+def plan_checks(session):
+    """
+    The daily-task and /watchlist queries, from the same builder functions the app
+    calls, with the indexes each must use. Returns [(name, query, expected_indexes)];
+    a tuple in expected_indexes means any one of those will do.
+    """
+
+    import daily_tasks
+    import watchlist
+
+    # The report and the cleanup anti-joins read every active follow, so either partial
+    # index will do. check_query_plans() separately fails any plan that reads inactive follows.
+    return [
+        (
+            '/watchlist: summary for a Slack user',
+            watchlist.summary_query(session, 'U0PLANCHECK'),
+            ['users_slack_id_key', 'watchlist_summaries_pkey']
+        ),
+        (
+            'weekly report: active follows by user',
+            daily_tasks.watchlist_report_query(session),
+            [ACTIVE_FOLLOW_INDEXES]
+        ),
+        (
+            'cleanup: series nobody follows',
+            daily_tasks.orphan_series_query(session),
+            [ACTIVE_FOLLOW_INDEXES]
+        ),
+        (
+            'cleanup: users who follow nothing',
+            daily_tasks.idle_users_query(session),
+            [ACTIVE_FOLLOW_INDEXES]
+        ),
+    ]
+
+
+def plan_nodes(plan):
+    """Every node of an EXPLAIN (FORMAT JSON) plan, parents before children"""
+
+    if isinstance(plan, list):
+        for node in plan:
+            for child in plan_nodes(node.get('Plan', node)):
+                yield child
+    else:
+        yield plan
+        for child in plan_nodes(plan.get('Plans', [])):
+            yield child
+
+
+def plan_index_names(plan):
+
+    return set(node['Index Name'] for node in plan_nodes(plan) if 'Index Name' in node)
+
+
+def inactive_follow_reads(plan):
+    """
+    The scans in `plan` that can read inactive follows, as 'Node Type (indexes)':
+    any read of users_following_tv_series other than through one of its partial indexes.
+    """
+
+    reads = []
+    for node in plan_nodes(plan):
+        if node.get('Relation Name') != follows.name:
+            continue
+        if node['Node Type'] == 'Bitmap Heap Scan':
+            # The heap scan names the table; the bitmap index scans under it name the indexes
+            indexes = plan_index_names(node.get('Plans', []))
+        else:
+            indexes = {node['Index Name']} if 'Index Name' in node else set()
+        if not indexes or not indexes.issubset(ACTIVE_FOLLOW_INDEXES):
+            reads.append('{} ({})'.format(node['Node Type'], ', '.join(sorted(indexes)) or 'no index'))
+
+    return reads
+
+
+def check_query_plans(engine=None):
+    """
+    EXPLAIN each hot query and confirm it uses its index and never reads
+    inactive follows. Sequential scans are disabled for the check, so a small
+    development database still shows whether the planner *can* use the index.
+    Returns True if all pass.
+    """
+
+    engine = engine or get_db_engine()
+    dialect = postgresql.dialect()
+    all_passed = True
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        connection.execute('SET LOCAL enable_seqscan = off')
+        session = OrmSession(bind=connection)
+        for name, query, expected_indexes in plan_checks(session):
+            compiled = query.statement.compile(dialect=dialect)
+            plan = connection.execute('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+            used = plan_index_names(plan)
+            inactive_reads = inactive_follow_reads(plan)
+            passed = not inactive_reads and all(
+                used.intersection(expected if isinstance(expected, tuple) else (expected,))
+                for expected in expected_indexes
+            )
+            all_passed = all_passed and passed
+            logger.info('%s %s: expected %s, plan uses %s',
+                        'PASS' if passed else 'FAIL', name, expected_indexes, sorted(used) or 'no index')
+            if inactive_reads:
+                logger.info('  reads inactive follows through: %s', ', '.join(inactive_reads))
+        session.close()
+        transaction.rollback()
+
+    return all_passed
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Manage the Jarvis database schema')
+    parser.add_argument('command', choices=['upgrade', 'status', 'check-plans'])
+    args = parser.parse_args()
+
+    # A standalone engine, so the app's own schema check doesn't run first
+    engine = create_db_engine()
+    if args.command == 'upgrade':
+        upgrade(engine)
+    elif args.command == 'status':
+        for version, description, _ in pending(engine):
+            print('pending {}: {}'.format(version, description))
+    elif args.command == 'check-plans':
+        sys.exit(0 if check_query_plans(engine) else 1)
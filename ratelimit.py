@@ -0,0 +1,51 @@
+import time
+import threading
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket.
+    `rate` tokens are added every second, up to `capacity`. acquire() blocks until a
+    token is free, and pause() empties the bucket when a server tells us to back off.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.time()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def acquire(self, tokens=1):
+        """Take `tokens` from the bucket, sleeping as needed. Returns the seconds waited."""
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return waited
+                    delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (e.g. after a 429 with Retry-After)."""
+
+        with self._lock:
+            now = time.time()
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = self._blocked_until
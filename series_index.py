@@ -0,0 +1,354 @@
+"""
+Type-ahead search over TVmaze's whole show catalog.
+The daily job keeps the catalog in the series_catalog table, so every dyno sees the
+same one. Each web process builds its trigram index from it on a background thread
+and swaps the new index in when it's ready.
+"""
+import os
+import re
+import math
+import time
+import logging
+import argparse
+import threading
+import unicodedata
+from datetime import datetime
+from sqlalchemy.exc import SQLAlchemyError
+import tvmaze
+import metrics
+import json_codec
+from db_schema import Series_Catalog, Session, create_db_session
+
+# setup logging
+logger = logging.getLogger('main.series_index')
+
+# Constants
+INDEX_FORMAT_VERSION = 1
+PAGE_SIZE = 250  # shows per page of TVmaze's /shows index
+MAX_OPTIONS = 50
+MAX_OPTION_LENGTH = 75  # Slack truncates option text beyond this
+MIN_CONTAINMENT = 0.5  # share of the query's trigrams a name must contain
+RELOAD_CHECK_SECONDS = int(os.environ.get('SERIES_INDEX_RELOAD_SECONDS', 60))
+
+# Catalog rows are plain lists, stored as one JSON document to keep loading quick
+ID, NAME, YEAR, WEIGHT, UPDATED = range(5)
+
+
+def normalize(text):
+
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', text.lower()).split())
+
+
+def trigrams(text, partial_last_word=False):
+    """
+    pg_trgm-style trigrams: each word is padded with two leading spaces and one trailing space.
+    The last word of a type-ahead query is still being typed, so its trailing trigram is left out.
+    """
+
+    grams = set()
+    words = normalize(text).split()
+    for i, word in enumerate(words):
+        padded = '  ' + word + ' '
+        if partial_last_word and i == len(words) - 1:
+            padded = padded[:-1]
+        for j in range(len(padded) - 2):
+            grams.add(padded[j:j + 3])
+
+    return grams
+
+
+class SeriesIndex(object):
+    """In-memory trigram index over the TVmaze show catalog"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.names = [normalize(row[NAME]) for row in rows]
+        self.grams = [frozenset(trigrams(row[NAME])) for row in rows]
+        self.postings = {}
+        for position, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(position)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, text, limit=MAX_OPTIONS):
+        """Return catalog rows matching `text`, best first"""
+
+        query = normalize(text)
+        query_grams = trigrams(text, partial_last_word=True)
+        if not query_grams:
+            return []
+
+        # A name holding at least `required` of the query's trigrams must appear in one of
+        # the (len - required + 1) rarest posting lists, so only those need scanning.
+        required = int(math.ceil(MIN_CONTAINMENT * len(query_grams)))
+        rarest = sorted(query_grams, key=lambda g: len(self.postings.get(g, ())))
+        candidates = set()
+        for gram in rarest[:len(query_grams) - required + 1]:
+            candidates.update(self.postings.get(gram, ()))
+
+        scored = []
+        for position in candidates:
+            shared = len(query_grams & self.grams[position])
+            if shared < required:
+                continue
+            containment = shared / len(query_grams)
+            similarity = shared / (len(query_grams) + len(self.grams[position]) - shared)
+            score = 0.7 * containment + 0.3 * similarity
+            name = self.names[position]
+            if name.startswith(query):
+                score += 0.3
+            elif query in name:
+                score += 0.15
+            scored.append((score, self.rows[position][WEIGHT] or 0, position))
+
+        scored.sort(reverse=True)
+
+        return [self.rows[position] for _, _, position in scored[:limit]]
+
+    def search_options(self, text, limit=MAX_OPTIONS):
+        """Slack external_select payload for `text`, in the same shape as tvmaze.search_for_series()"""
+
+        options = []
+        for row in self.search(text, limit):
+            series_output = row[NAME]
+            if row[YEAR]:
+                series_output += ' ({})'.format(row[YEAR])
+            options.append({
+                'text': {
+                    'type': 'plain_text',
+                    'text': series_output[:MAX_OPTION_LENGTH]
+                },
+                'value': str(row[ID])
+            })
+
+        return {
+            'options': options
+        }
+
+
+def catalog_row(show):
+
+    premiered = show.get('premiered')
+    return (
+        show['id'],
+        show.get('name') or '',
+        premiered[0:4] if premiered else '',
+        show.get('weight'),
+        show.get('updated')
+    )
+
+
+def load_catalog(session, newer_than=None):
+    """
+    The latest catalog as {'id', 'last_page', 'rows'}, or None if there is none
+    (or, with `newer_than`, none newer than that catalog id).
+    """
+
+    query = session.query(Series_Catalog.id, Series_Catalog.format_version, Series_Catalog.last_page, Series_Catalog.rows)
+    if newer_than is not None:
+        query = query.filter(Series_Catalog.id > newer_than)
+    latest = query.order_by(Series_Catalog.id.desc()).first()
+    if latest is None:
+        return None
+    if latest.format_version != INDEX_FORMAT_VERSION:
+        raise ValueError('Unsupported series index format: {}'.format(latest.format_version))
+
+    return {
+        'id': latest.id,
+        'last_page': latest.last_page,
+        'rows': json_codec.loads(latest.rows)
+    }
+
+
+def save_catalog(session, catalog):
+
+    # The new row and the removal of the old ones commit together, so readers
+    # always find exactly one complete catalog
+    saved = Series_Catalog(
+        format_version=INDEX_FORMAT_VERSION,
+        last_page=catalog['last_page'],
+        show_count=len(catalog['rows']),
+        rows=json_codec.dumps(catalog['rows']).encode('utf-8'),
+        created_at=datetime.utcnow()
+    )
+    session.add(saved)
+    session.flush()
+    session.query(Series_Catalog). \
+        filter(Series_Catalog.id < saved.id). \
+        delete(synchronize_session=False)
+    session.commit()
+
+    return saved.id
+
+
+def fetch_catalog_page(page):
+    """Return the shows on one page of TVmaze's /shows index, or None past the last page"""
+
+    response = tvmaze.fetch_with_backoff(tvmaze.API_URL + '/shows', params={'page': page})
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+
+    return json_codec.loads(response.content)
+
+
+def update_catalog(show_updates=None, full_rebuild=False):
+    """
+    Bring the stored catalog up to date.
+    TVmaze pages its show index by id, so only the pages holding shows that changed
+    since the last run, plus the pages at the end where new shows land, are fetched.
+    """
+
+    logger.info('Updating the series index (full rebuild: %s)', full_rebuild)
+    start_time = time.time()
+
+    session = create_db_session()
+    catalog = None
+    if not full_rebuild:
+        try:
+            catalog = load_catalog(session)
+        except ValueError as e:
+            logger.warning('Could not load the series index, rebuilding it: %s', e)
+    # Don't sit in a transaction while TVmaze is paged through
+    session.commit()
+
+    if catalog is None:
+        shows = {}
+        pages = set()
+        next_page = 0
+    else:
+        shows = {row[ID]: row for row in catalog['rows']}
+        if show_updates is None:
+            show_updates = tvmaze.get_show_updates() or {}
+        pages = set(
+            series_id // PAGE_SIZE for series_id, timestamp in show_updates.items()
+            if series_id not in shows or (shows[series_id][UPDATED] or 0) < timestamp
+        )
+        next_page = catalog['last_page']
+
+    fetched = 0
+    for page in sorted(p for p in pages if p < next_page):
+        page_shows = fetch_catalog_page(page)
+        fetched += 1
+        for show in page_shows or []:
+            shows[show['id']] = catalog_row(show)
+
+    # Walk forward from the last known page until TVmaze runs out of shows
+    page = next_page
+    while True:
+        page_shows = fetch_catalog_page(page)
+        fetched += 1
+        if not page_shows:
+            break
+        for show in page_shows:
+            shows[show['id']] = catalog_row(show)
+        page += 1
+
+    catalog = {
+        'last_page': max(page - 1, 0),
+        'rows': sorted(shows.values())
+    }
+    catalog['id'] = save_catalog(session, catalog)
+    session.close()
+
+    logger.info('Series index holds %d shows (%d pages fetched in %.1fs)',
+                len(catalog['rows']), fetched, time.time() - start_time)
+
+    return catalog
+
+
+_index = None
+_catalog_id = None
+_checked_at = 0.0
+_loader_pid = None  # process whose loader thread is running, if any
+_loader_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Return the current index, or None if none has been loaded yet. Never blocks:
+    every RELOAD_CHECK_SECONDS a background thread looks for a newer catalog and
+    builds its index, while searches carry on with the one already loaded.
+    """
+    global _checked_at, _loader_pid
+
+    now = time.time()
+    if now - _checked_at < RELOAD_CHECK_SECONDS:
+        return _index
+
+    pid = os.getpid()
+    with _loader_lock:
+        # A loader inherited through fork isn't running in this process
+        if now - _checked_at >= RELOAD_CHECK_SECONDS and _loader_pid != pid:
+            _checked_at = now
+            _loader_pid = pid
+            loader = threading.Thread(target=_load_in_background, name='series-index-loader')
+            loader.daemon = True
+            loader.start()
+
+    return _index
+
+
+def _load_in_background():
+    global _loader_pid
+
+    try:
+        load_index()
+    except Exception:
+        logger.exception('Series index loader failed')
+    finally:
+        with _loader_lock:
+            _loader_pid = None
+
+
+def load_index():
+    """Load the latest catalog into the index if it's newer than the one in use. Returns the index."""
+    global _index, _catalog_id
+
+    try:
+        session = create_db_session()
+        catalog = load_catalog(session, newer_than=_catalog_id)
+    except (SQLAlchemyError, ValueError) as e:
+        logger.error('Could not load the series index: %s', e)
+        return _index
+    finally:
+        # Release the connection now rather than when the thread's session is next used
+        Session.remove()
+
+    if catalog is not None:
+        start_time = time.time()
+        _index = SeriesIndex(catalog['rows'])
+        _catalog_id = catalog['id']
+        logger.info('Loaded %d shows into the series index in %.2fs', len(_index), time.time() - start_time)
+
+    return _index
+
+
+@metrics.timed('render', block='search_options')
+def search_options(text):
+    """Lookahead payload from the local index, or None when the index can't answer"""
+
+    index = get_index()
+    if index is None:
+        return None
+
+    payload = index.search_options(text)
+    if not payload['options']:
+        return None
+
+    return payload
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Build or update the local TVmaze series index')
+    parser.add_argument('--rebuild', action='store_true', help='discard the existing index and rebuild it')
+    args = parser.parse_args()
+
+    update_catalog(full_rebuild=args.rebuild)
@@ -1,17 +1,169 @@
 import os
+import time
+import requests
 import logging
+import threading
+import metrics
+import log_setup
+import json_codec
+import http_client
 from slackclient import SlackClient
+from slackclient.slackrequest import SlackRequest
+from ratelimit import TokenBucket
+from db_schema import User, create_db_session
 
 # setup logging
 logger = logging.getLogger('main.slack')
 
-# authenticate with Slack
-token = os.environ["SLACK_BOT_TOKEN"]
-slack_client = SlackClient(token)
+# Slack's Web API rate limit tiers, in requests per minute
+RATE_LIMIT_TIERS = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100
+}
+METHOD_RATE_LIMITS = {
+    'chat.postMessage': 60,  # special tier: roughly one message per second
+    'chat.postEphemeral': RATE_LIMIT_TIERS[4],
+    'chat.delete': RATE_LIMIT_TIERS[3],
+    'dialog.open': RATE_LIMIT_TIERS[4],
+    'files.upload': RATE_LIMIT_TIERS[2],
+    'im.open': RATE_LIMIT_TIERS[3]
+}
+MAX_RETRIES = int(os.environ.get('SLACK_MAX_RETRIES', 3))
+RATE_LIMITING = os.environ.get('SLACK_RATE_LIMITING', '1') == '1'
+RESPONSE_URL_TIMEOUT = float(os.environ.get('SLACK_RESPONSE_URL_TIMEOUT', 1.0))
+# Base URL of a local Slack stand-in (see benchmark.py); unset in production
+LOCAL_API_URL = os.environ.get('SLACK_API_URL')
+stale_channel_errors = ('channel_not_found', 'is_archived', 'not_in_channel')
+dm_channels = {}  # slack_id -> DM channel id
+
+rate_limiters = {
+    method: TokenBucket(rate=per_minute / 60.0, capacity=max(1, per_minute // 10))
+    for method, per_minute in METHOD_RATE_LIMITS.items()
+}
+
+_slack_client = None
+_slack_client_lock = threading.Lock()
+
+
+class LocalSlackRequest(SlackRequest):
+    """Sends Web API calls to LOCAL_API_URL over plain HTTP instead of https://slack.com"""
+
+    def __init__(self, base_url):
+        super(LocalSlackRequest, self).__init__()
+        self.base_url = base_url.rstrip('/')
+
+    def do(self, token=None, request="?", post_data=None, as_user=None, domain="slack.com", timeout=None):
+
+        post_data = dict(post_data or {})
+        for key, value in post_data.items():
+            if isinstance(value, (list, dict)):
+                post_data[key] = json_codec.dumps(value)
+
+        return requests.post(
+            '{}/api/{}'.format(self.base_url, request),
+            headers={'Authorization': 'Bearer {}'.format(token)},
+            data=post_data,
+            timeout=timeout
+        )
+
+
+def get_slack_client():
+    """Create and check the Slack client on first use rather than at import"""
+    global _slack_client
+
+    if _slack_client is not None:
+        return _slack_client
+
+    with _slack_client_lock:
+        if _slack_client is None:
+            # authenticate with Slack
+            token = os.environ["SLACK_BOT_TOKEN"]
+            slack_client = SlackClient(token)
+            if LOCAL_API_URL:
+                slack_client.server.api_requester = LocalSlackRequest(LOCAL_API_URL)
+
+            test_response = slack_client.api_call('api.test')
+            if not test_response.get('ok'):
+                logger.error('API connection failed. Response error: <%s>', test_response.get('error'))
+            _slack_client = slack_client
+
+    return _slack_client
+
+
+def api_call(method, **kwargs):
+    """
+    Call a Slack Web API method within its rate limit tier.
+    A 'ratelimited' response pauses the method's limiter for Slack's Retry-After
+    and the call is repeated, up to MAX_RETRIES times.
+    """
+
+    with metrics.span('slack', method=method):
+        return _call_with_retries(method, kwargs)
+
+
+def _call_with_retries(method, kwargs):
+
+    rate_limiter = rate_limiters.get(method) if RATE_LIMITING else None
+    for attempt in range(MAX_RETRIES + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        response = get_slack_client().api_call(method, **kwargs)
+        if response.get('error') != 'ratelimited' or attempt == MAX_RETRIES:
+            return response
+
+        try:
+            delay = float(response.get('headers', {}).get('Retry-After'))
+        except (TypeError, ValueError):
+            delay = 2 ** attempt
+        logger.warning("Slack rate limited '%s'. Retrying in %.1fs", method, delay)
+        if rate_limiter:
+            rate_limiter.pause(delay)
+        else:
+            time.sleep(delay)
+
+    return response
+
+
+def get_dm_channel(slack_id, refresh=False):
+    """
+    Return the id of the bot's DM channel with a user.
+    Looked up in the in-process cache, then on the users table, and only opened
+    with im.open when neither knows it (or `refresh` is set).
+    """
+
+    if not refresh:
+        channel_id = dm_channels.get(slack_id)
+        if channel_id:
+            return channel_id
 
-test_response = slack_client.api_call('api.test')
-if not test_response.get('ok'):
-    logger.error('API connection failed. Response error: <%s>', test_response.get('error'))
+        session = create_db_session()
+        channel_id = session.query(User.dm_channel_id). \
+            filter_by(slack_id=slack_id). \
+            scalar()
+        session.close()
+        if channel_id:
+            dm_channels[slack_id] = channel_id
+            return channel_id
+
+    response = api_call('im.open', user=slack_id)
+    if not response.get('ok'):
+        logger.error("Could not open a DM channel with '%s': %s", slack_id, response.get('error'))
+        return None
+
+    channel_id = response.get('channel').get('id')
+    dm_channels[slack_id] = channel_id
+
+    # Users who never followed a show have no row; the in-process cache still covers them
+    session = create_db_session()
+    session.query(User). \
+        filter_by(slack_id=slack_id). \
+        update({'dm_channel_id': channel_id})
+    session.commit()
+    session.close()
+
+    return channel_id
 
 
 def post_message(blocks, channel_id=None, slack_id=None, ephemeral=False):
@@ -23,38 +175,76 @@ def post_message(blocks, channel_id=None, slack_id=None, ephemeral=False):
     else:
         post_type = 'chat.postMessage'
 
-    if not channel_id:
-        response = slack_client.api_call('im.open', user=slack_id)
-        if response.get('ok'):
-            channel_id = response.get('channel').get('id')
-
-    logger.debug('Posting to channel_id: {}'.format(channel_id))
-    response = slack_client.api_call(post_type, user=slack_id, channel=channel_id, blocks=blocks, as_user=True)
+    direct_message = not channel_id
+    if direct_message:
+        channel_id = get_dm_channel(slack_id)
+
+    logger.debug('Posting to channel_id: %s', channel_id)
+    # Encoded here, once, rather than by slackclient on every attempt
+    blocks = json_codec.dumps(blocks)
+    response = api_call(post_type, user=slack_id, channel=channel_id, blocks=blocks, as_user=True)
+    if direct_message and response.get('error') in stale_channel_errors:
+        logger.info("Stored DM channel for '%s' is no longer valid. Reopening it", slack_id)
+        channel_id = get_dm_channel(slack_id, refresh=True)
+        response = api_call(post_type, user=slack_id, channel=channel_id, blocks=blocks, as_user=True)
     logger.info('Finished posting message to Slack')
-    logger.debug('Server response from posting output:\n{}'.format(response))
+    logger.debug('Server response from posting output:\n%s', log_setup.truncate(response))
+
+    return response
+
+
+def post_response(response_url, text):
+    """
+    Post an ephemeral reply to an interaction's response_url.
+    Sent once with a short timeout, outside the rate limiters and retries, so it's
+    safe to call on a request thread that still has to ack Slack in time.
+    """
+
+    payload = {
+        'response_type': 'ephemeral',
+        'replace_original': False,
+        'text': text
+    }
+    try:
+        response = http_client.post(
+            response_url,
+            data=json_codec.dumps(payload),
+            headers={'Content-Type': 'application/json'},
+            retries=0,
+            timeout=RESPONSE_URL_TIMEOUT
+        )
+    except requests.RequestException as e:
+        logger.error('Could not post to response_url: %s', e)
+        return False
+
+    if response.status_code != 200:
+        logger.error('Posting to response_url failed with HTTP %s', response.status_code)
+        return False
+
+    return True
 
 
 def delete_message(channel_id, message_ts):
 
     logger.info("Deleting message from slack")
 
-    response = slack_client.api_call("chat.delete", channel=channel_id, ts=message_ts, as_user=True)
+    response = api_call("chat.delete", channel=channel_id, ts=message_ts, as_user=True)
     logger.info("Finished deleting message")
-    logger.debug('Server response from deleting message:\n{}'.format(response))
+    logger.debug('Server response from deleting message:\n%s', log_setup.truncate(response))
 
 
 def post_dialog(dialog, trigger_id):
 
     logger.info("Posting dialog")
-    response = slack_client.api_call("dialog.open", dialog=dialog, trigger_id=trigger_id)
+    response = api_call("dialog.open", dialog=json_codec.dumps(dialog), trigger_id=trigger_id)
     logger.info("Finished posting dialog")
-    logger.debug("Server response from posting dialog:\n{}".format(response))
+    logger.debug("Server response from posting dialog:\n%s", log_setup.truncate(response))
 
 
 def post_file(channel_id, content, title):
 
     channels = [channel_id]
     logger.info("Posting spoiler content")
-    response = slack_client.api_call("files.upload", content=content, title=title, channels=channels)
+    response = api_call("files.upload", content=content, title=title, channels=channels)
     logger.info("Finished posting spoiler content")
-    logger.debug("Server response from posting spoiler content:\n{}".format(response))
\ No newline at end of file
+    logger.debug("Server response from posting spoiler content:\n%s", log_setup.truncate(response))
\ No newline at end of file
@@ -0,0 +1,63 @@
+import os
+import sys
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.pool import StaticPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_schema
+
+
+@pytest.fixture
+def db_engine():
+    """
+    An in-memory SQLite database with the current models, installed as the app's
+    engine so create_db_session() hands out sessions bound to it.
+    """
+
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    db_schema.Base.metadata.create_all(engine)
+
+    saved = db_schema._engine, db_schema._engine_pid
+    db_schema._engine, db_schema._engine_pid = engine, os.getpid()
+    db_schema.Session.remove()
+    db_schema.Session.configure(bind=engine)
+    yield engine
+
+    db_schema.Session.remove()
+    db_schema._engine, db_schema._engine_pid = saved
+    engine.dispose()
+
+
+@pytest.fixture
+def db_session(db_engine):
+
+    session = db_schema.create_db_session()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def pg_session():
+    """
+    A session on TEST_DATABASE_URL, a scratch Postgres database, for the queries
+    SQLite can't run. Everything it does is rolled back. Skipped when the URL isn't set.
+    """
+
+    database_url = os.environ.get('TEST_DATABASE_URL')
+    if not database_url:
+        pytest.skip('TEST_DATABASE_URL is not set')
+
+    engine = create_engine(database_url)
+    db_schema.Base.metadata.create_all(engine)
+    connection = engine.connect()
+    transaction = connection.begin()
+    session = OrmSession(bind=connection)
+    yield session
+
+    session.close()
+    transaction.rollback()
+    connection.close()
+    engine.dispose()
@@ -0,0 +1,64 @@
+import json
+import tvmaze
+import bulk_watchlist
+
+
+class FakeResponse(object):
+
+    def __init__(self, payload, status_code=200):
+        self.content = json.dumps(payload)
+        self.status_code = status_code
+
+
+def stub_tvmaze(monkeypatch, responses):
+    """Answer fetch_with_backoff from {url: FakeResponse}, recording the URLs fetched"""
+
+    fetched = []
+
+    def fetch_with_backoff(url, params=None):
+        fetched.append(url)
+        return responses[url]
+
+    monkeypatch.setattr(tvmaze, 'fetch_with_backoff', fetch_with_backoff)
+    return fetched
+
+
+def test_imdb_entry_reuses_the_lookup_payload(monkeypatch):
+
+    show = {'id': 169, 'name': 'Breaking Bad', '_embedded': {'nextepisode': {'season': 6, 'number': 1}}}
+    fetched = stub_tvmaze(monkeypatch, {tvmaze.API_URL + '/lookup/shows': FakeResponse(show)})
+
+    assert bulk_watchlist.resolve_entry(('imdb', 'tt0903747'), set()) == (169, show)
+    assert fetched == [tvmaze.API_URL + '/lookup/shows']
+
+
+def test_imdb_entry_fetches_only_the_next_episode_when_the_embed_is_dropped(monkeypatch):
+
+    episode_url = tvmaze.API_URL + '/episodes/1'
+    show = {'id': 169, 'name': 'Breaking Bad', '_links': {'nextepisode': {'href': episode_url}}}
+    fetched = stub_tvmaze(monkeypatch, {
+        tvmaze.API_URL + '/lookup/shows': FakeResponse(show),
+        episode_url: FakeResponse({'season': 6, 'number': 1})
+    })
+
+    series_id, series_data = bulk_watchlist.resolve_entry(('imdb', 'tt0903747'), set())
+
+    assert series_id == 169
+    assert series_data['_embedded']['nextepisode'] == {'season': 6, 'number': 1}
+    assert fetched == [tvmaze.API_URL + '/lookup/shows', episode_url]
+
+
+def test_imdb_entry_without_a_next_episode(monkeypatch):
+
+    show = {'id': 169, 'name': 'Breaking Bad', 'status': 'Ended', '_links': {}}
+    fetched = stub_tvmaze(monkeypatch, {tvmaze.API_URL + '/lookup/shows': FakeResponse(show)})
+
+    assert bulk_watchlist.resolve_entry(('imdb', 'tt0903747'), set()) == (169, show)
+    assert len(fetched) == 1
+
+
+def test_unknown_imdb_entry_is_unresolved(monkeypatch):
+
+    stub_tvmaze(monkeypatch, {tvmaze.API_URL + '/lookup/shows': FakeResponse(None, status_code=404)})
+
+    assert bulk_watchlist.resolve_entry(('imdb', 'tt0000001'), set()) is None
@@ -0,0 +1,89 @@
+from cache import LRUCache, PrefixCache
+
+
+def test_lru_cache_evicts_least_recently_used_past_max_entries():
+
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1, ttl=60)
+    cache.set('b', 2, ttl=60)
+    assert cache.get('a') == 1  # 'b' is now the least recently used
+    cache.set('c', 3, ttl=60)
+
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert cache.stats()['evictions'] == 1
+
+
+def test_lru_cache_evicts_past_max_bytes():
+
+    cache = LRUCache(max_entries=10, max_bytes=100)
+    cache.set('a', 'x', ttl=60, size=40)
+    cache.set('b', 'y', ttl=60, size=40)
+    cache.set('c', 'z', ttl=60, size=40)
+
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes'], stats['evictions']) == (2, 80, 1)
+
+    # A value larger than the whole cache isn't stored, and evicts nothing
+    cache.set('huge', 'w', ttl=60, size=101)
+    assert cache.get('huge') is None
+    assert cache.stats()['entries'] == 2
+
+
+def test_lru_cache_replacing_a_key_keeps_the_byte_count():
+
+    cache = LRUCache(max_bytes=100)
+    cache.set('a', 'x', ttl=60, size=30)
+    cache.set('a', 'y', ttl=60, size=50)
+
+    assert cache.get('a') == 'y'
+    assert cache.stats()['bytes'] == 50
+
+
+def test_lru_cache_expires_entries():
+
+    cache = LRUCache()
+    cache.set('a', 1, ttl=0)
+
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['expirations'], stats['misses'], stats['entries'], stats['bytes']) == (1, 1, 0, 0)
+
+
+def refine(results, query):
+    return [name for name in results if name.startswith(query)]
+
+
+def test_prefix_cache_answers_from_a_complete_prefix():
+
+    cache = PrefixCache(refine, min_prefix=3)
+    cache.set('bre', ['breaking bad', 'breaking in', 'brew'], complete=True, ttl=60)
+
+    assert cache.get('bre') == ['breaking bad', 'breaking in', 'brew']
+    assert cache.get('breaking b') == ['breaking bad']
+    stats = cache.stats()
+    assert (stats['hits'], stats['prefix_hits'], stats['misses'], stats['saved_calls']) == (1, 1, 0, 2)
+
+
+def test_prefix_cache_skips_incomplete_prefixes():
+
+    cache = PrefixCache(refine, min_prefix=3)
+    cache.set('bre', ['breaking bad'], complete=False, ttl=60)
+
+    assert cache.get('brea') is None
+
+    # A longer complete prefix still answers
+    cache.set('brea', ['breaking bad'], complete=True, ttl=60)
+    assert cache.get('break') == ['breaking bad']
+    stats = cache.stats()
+    assert (stats['prefix_hits'], stats['misses'], stats['saved_calls']) == (1, 1, 1)
+
+
+def test_prefix_cache_ignores_prefixes_shorter_than_min_prefix():
+
+    cache = PrefixCache(refine, min_prefix=3)
+    cache.set('br', ['breaking bad'], complete=True, ttl=60)
+
+    assert cache.get('bre') is None
+    assert cache.stats()['misses'] == 1
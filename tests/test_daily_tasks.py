@@ -0,0 +1,97 @@
+from datetime import date, timedelta
+from sqlalchemy import event
+import daily_tasks
+from benchmark import RoundTripCounter
+from db_schema import User, TV_Series, Follow
+
+
+def seed_follows(session, users, series_per_user):
+    """`users` users, each following `series_per_user` of a shared pool of series"""
+
+    all_series = [
+        TV_Series(tvmaze_id=i, name='Series {}'.format(i), status='Running',
+                  next_episode_date=date.today() + timedelta(days=i % 7) if i % 2 else None,
+                  next_episode_season=1, next_episode_number=i % 10 + 1)
+        for i in range(series_per_user * 2)
+    ]
+    session.add_all(all_series)
+    session.flush()
+    for i in range(users):
+        user = User(slack_id='U{:06d}'.format(i), slack_name='user{}'.format(i))
+        session.add(user)
+        session.flush()
+        session.add_all(
+            Follow(user_id=user.id, tv_series_id=series.id, is_following=True)
+            for series in all_series[i % series_per_user:][:series_per_user]
+        )
+    session.commit()
+
+
+def statements_to_collect(db_engine):
+
+    counter = RoundTripCounter(db_engine)
+    watchlist_data = daily_tasks.collect_watchlist_data()
+
+    return counter.count, watchlist_data
+
+
+def test_collect_watchlist_data_query_count_is_constant(db_engine, db_session, monkeypatch):
+
+    # Small fetches, so the larger seed streams over many batches
+    monkeypatch.setattr(daily_tasks, 'WATCHLIST_FETCH_SIZE', 50)
+
+    seed_follows(db_session, users=20, series_per_user=5)
+    small_count, small_data = statements_to_collect(db_engine)
+
+    db_session.query(Follow).delete()
+    db_session.query(User).delete()
+    db_session.query(TV_Series).delete()
+    seed_follows(db_session, users=200, series_per_user=5)
+    large_count, large_data = statements_to_collect(db_engine)
+
+    assert len(small_data) == 20 and len(large_data) == 200
+    assert sum(len(series) for user in large_data.values() for series in user.values()) == 200 * 5
+    assert small_count == large_count == 1
+
+
+def seed_cleanup(session):
+    """One followed series, four orphans and two idle users, with two inactive follows to clear out"""
+
+    series = [TV_Series(tvmaze_id=i, name='Series {}'.format(i), status='Running') for i in range(5)]
+    users = [User(slack_id='U{}'.format(i), slack_name='user{}'.format(i)) for i in range(3)]
+    session.add_all(series + users)
+    session.flush()
+    session.add_all([
+        Follow(user_id=users[0].id, tv_series_id=series[0].id, is_following=True),
+        Follow(user_id=users[0].id, tv_series_id=series[1].id, is_following=False),
+        Follow(user_id=users[1].id, tv_series_id=series[0].id, is_following=False)
+    ])
+    session.commit()
+
+
+def test_database_cleanup_dry_run_only_counts(db_session):
+
+    seed_cleanup(db_session)
+
+    stats = daily_tasks.database_cleanup(dry_run=True)
+
+    assert (stats['orphan_series'], stats['idle_users']) == (4, 2)
+    assert stats['series_deleted'] == stats['users_deleted'] == stats['follows_deleted'] == 0
+    assert (db_session.query(TV_Series).count(), db_session.query(User).count()) == (5, 3)
+
+
+def test_database_cleanup_deletes_in_batches_and_keeps_followed_series(db_engine, db_session, monkeypatch):
+
+    monkeypatch.setattr(daily_tasks, 'CLEANUP_BATCH', 2)
+    seed_cleanup(db_session)
+    commits = []
+    event.listen(db_engine, 'commit', lambda connection: commits.append(connection))
+
+    stats = daily_tasks.database_cleanup()
+
+    # Two batches of orphan series, one of idle users, each committed on its own
+    assert len(commits) == 3
+    assert (stats['series_deleted'], stats['users_deleted'], stats['follows_deleted']) == (4, 2, 2)
+    assert [series.tvmaze_id for series in db_session.query(TV_Series)] == [0]
+    assert [user.slack_id for user in db_session.query(User)] == ['U0']
+    assert [(follow.tv_series_id, follow.is_following) for follow in db_session.query(Follow)] == [(1, True)]
@@ -0,0 +1,109 @@
+import time
+import threading
+import requests
+import http_client
+
+CALLERS = 10
+
+
+class FakeResponse(object):
+
+    status_code = 200
+    content = b'{"id": 1}'
+
+
+class CountingEvent(threading.Event):
+    """An Event that counts the threads waiting on it"""
+
+    waiters = 0
+    lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        with CountingEvent.lock:
+            CountingEvent.waiters += 1
+        return super(CountingEvent, self).wait(timeout)
+
+
+class CountingInFlight(http_client.InFlight):
+
+    def __init__(self):
+        super(CountingInFlight, self).__init__()
+        self.done = CountingEvent()
+
+
+def get_concurrently(monkeypatch, url, send):
+    """GET `url` from CALLERS threads at once, with _send held until every follower waits on the leader"""
+
+    release = threading.Event()
+    sent = []
+
+    def held_send(*args):
+        sent.append(args)
+        release.wait(5)
+        return send()
+
+    monkeypatch.setattr(http_client, '_send', held_send)
+    monkeypatch.setattr(http_client, 'InFlight', CountingInFlight)
+    monkeypatch.setattr(CountingEvent, 'waiters', 0)
+
+    outcomes = [None] * CALLERS
+
+    def call(i):
+        try:
+            outcomes[i] = http_client.get(url)
+        except Exception as e:
+            outcomes[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(CALLERS)]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 5
+    while CountingEvent.waiters < CALLERS - 1 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    return sent, outcomes
+
+
+def test_concurrent_gets_for_one_url_send_one_request(monkeypatch):
+
+    response = FakeResponse()
+    sent, outcomes = get_concurrently(monkeypatch, 'http://coalesce.test/shows/1', lambda: response)
+
+    assert len(sent) == 1
+    assert all(outcome is response for outcome in outcomes)
+    assert http_client.host_stats('coalesce.test')['coalesced'] == CALLERS - 1
+    assert not http_client.get_host_pool('coalesce.test').in_flight
+
+
+def test_followers_get_the_leaders_error(monkeypatch):
+
+    error = requests.ConnectionError('connection refused')
+
+    def fail():
+        raise error
+
+    sent, outcomes = get_concurrently(monkeypatch, 'http://coalesce-error.test/shows/1', fail)
+
+    assert len(sent) == 1
+    assert all(outcome is error for outcome in outcomes)
+    assert not http_client.get_host_pool('coalesce-error.test').in_flight
+
+
+def test_different_urls_and_posts_are_not_coalesced(monkeypatch):
+
+    sent = []
+
+    def send(method, url, *args):
+        sent.append((method, url))
+        return FakeResponse()
+
+    monkeypatch.setattr(http_client, '_send', send)
+    http_client.get('http://coalesce-none.test/shows/1')
+    http_client.get('http://coalesce-none.test/shows/1', params={'embed': 'nextepisode'})
+    http_client.post('http://coalesce-none.test/shows/1')
+
+    assert len(sent) == 3
+    assert http_client.host_stats('coalesce-none.test')['coalesced'] == 0
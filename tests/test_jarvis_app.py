@@ -0,0 +1,98 @@
+import json
+import pytest
+import jobs
+import metrics
+import series_index
+import jarvis_app
+
+
+@pytest.fixture(autouse=True)
+def no_series_index(monkeypatch):
+    # Keep the first request from starting the index loader, which would need a database
+    monkeypatch.setattr(series_index, 'get_index', lambda: None)
+
+
+def reject_jobs(monkeypatch):
+
+    monkeypatch.setattr(jobs.background, 'submit', lambda fn, *args: False)
+    monkeypatch.setattr(jobs.bulk, 'submit', lambda fn, *args: False)
+
+
+def test_watchlist_import_reports_a_dropped_job(monkeypatch):
+
+    reject_jobs(monkeypatch)
+    response = jarvis_app.app.test_client().post('/watchlist-import', data={
+        'text': 'tvmaze:169', 'user_id': 'U1', 'user_name': 'walter', 'channel_id': 'C1'
+    })
+
+    assert json.loads(response.data)['text'] == jarvis_app.BUSY_TEXT
+
+
+def test_watchlist_export_reports_a_dropped_job(monkeypatch):
+
+    reject_jobs(monkeypatch)
+    response = jarvis_app.app.test_client().post('/watchlist-export', data={
+        'user_id': 'U1', 'user_name': 'walter', 'channel_id': 'C1'
+    })
+
+    assert json.loads(response.data)['text'] == jarvis_app.BUSY_TEXT
+
+
+def test_watchlist_import_runs_on_the_bulk_executor(monkeypatch):
+
+    submitted = []
+    monkeypatch.setattr(jobs.background, 'submit', lambda fn, *args: 1 / 0)
+    monkeypatch.setattr(jobs.bulk, 'submit', lambda fn, *args: submitted.append(fn) or True)
+    jarvis_app.app.test_client().post('/watchlist-import', data={
+        'text': 'tvmaze:169', 'user_id': 'U1', 'user_name': 'walter', 'channel_id': 'C1'
+    })
+
+    assert submitted == [jarvis_app.bulk_watchlist.import_watchlist]
+
+
+def test_button_click_reports_a_dropped_job(monkeypatch):
+
+    reject_jobs(monkeypatch)
+    posted = []
+    monkeypatch.setattr(jarvis_app, 'post_message', lambda blocks, **kwargs: 1 / 0)
+    monkeypatch.setattr(jarvis_app, 'post_response', lambda url, text: posted.append((url, text)))
+    payload = json.dumps({
+        'type': 'block_actions',
+        'user': {'id': 'U1', 'name': 'walter'},
+        'channel': {'id': 'C1'},
+        'response_url': 'https://hooks.slack.com/actions/T1/1/abc',
+        'actions': [{'action_id': 'add_to_watchlist', 'value': '169'}]
+    })
+
+    response = jarvis_app.app.test_client().post('/', data={'payload': payload})
+
+    assert response.status_code == 200
+    assert posted == [('https://hooks.slack.com/actions/T1/1/abc', jarvis_app.BUSY_TEXT)]
+
+
+def test_button_click_is_queued(monkeypatch):
+
+    submitted = []
+    monkeypatch.setattr(jobs.background, 'submit', lambda fn, *args: submitted.append(fn) or True)
+    monkeypatch.setattr(jarvis_app, 'post_message', lambda blocks, **kwargs: 1 / 0)
+    payload = json.dumps({
+        'type': 'block_actions',
+        'user': {'id': 'U1', 'name': 'walter'},
+        'channel': {'id': 'C1'},
+        'actions': [{'action_id': 'remove_from_watchlist', 'value': '169'}]
+    })
+
+    jarvis_app.app.test_client().post('/', data={'payload': payload})
+
+    assert submitted == [jarvis_app.respond_to_remove_from_watchlist]
+
+
+def test_unmatched_paths_share_one_trace_label():
+
+    client = jarvis_app.app.test_client()
+    for path in ('/wp-login.php', '/.env', '/admin/config.php'):
+        assert client.get(path).status_code == 404
+
+    traces = [name for name in metrics.snapshot() if name.startswith('trace_seconds')]
+    assert 'trace_seconds{trace="unmatched"}' in traces
+    assert not [name for name in traces if '.php' in name or '.env' in name]
@@ -0,0 +1,39 @@
+import os
+import sys
+import subprocess
+import log_setup
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FORKING_APP = """
+import os
+import log_setup
+
+logger = log_setup.configure_logging('app.log', logger_name='forking_app')
+logger.info('from the parent')
+pid = os.fork()
+if pid == 0:
+    logger.info('from the child')
+    log_setup._stop_listener()
+    os._exit(0)
+os.waitpid(pid, 0)
+print(pid)
+"""
+
+
+def test_process_log_file():
+
+    assert log_setup.process_log_file('jarvis_app.log', pid=42) == 'jarvis_app.42.log'
+    assert log_setup.process_log_file('logs/app', pid=42) == 'logs/app.42'
+
+
+def test_forked_processes_write_their_own_log_file(tmp_path):
+
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    output = subprocess.check_output([sys.executable, '-c', FORKING_APP], cwd=str(tmp_path), env=env)
+    child_pid = int(output.decode().split()[-1])
+
+    parent_log = (tmp_path / 'app.log').read_text()
+    child_log = (tmp_path / 'app.{}.log'.format(child_pid)).read_text()
+    assert 'from the parent' in parent_log and 'from the child' not in parent_log
+    assert 'from the child' in child_log and 'from the parent' not in child_log
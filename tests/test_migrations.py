@@ -0,0 +1,70 @@
+from sqlalchemy import create_engine, inspect, select
+import migrations
+
+
+def test_released_migrations_build_summaries_from_their_own_tables():
+
+    engine = create_engine('sqlite://')
+    with engine.begin() as connection:
+        migrations.create_tables(connection)
+        migrations.create_indexes(connection)
+        connection.execute(migrations.users.insert(), [
+            {'id': 1, 'slack_id': 'U1', 'slack_name': 'walter'},
+            {'id': 2, 'slack_id': 'U2', 'slack_name': 'jesse'}
+        ])
+        connection.execute(migrations.tv_series.insert(), [
+            {'id': 1, 'tvmaze_id': 169, 'name': 'Breaking Bad', 'status': 'Ended'},
+            {'id': 2, 'tvmaze_id': 618, 'name': 'Better Call Saul', 'status': 'Ended'},
+            {'id': 3, 'tvmaze_id': 1371, 'name': 'Westworld', 'status': 'Ended'}
+        ])
+        connection.execute(migrations.follows.insert(), [
+            {'user_id': 1, 'tv_series_id': 1, 'is_following': True},
+            {'user_id': 1, 'tv_series_id': 2, 'is_following': True},
+            {'user_id': 1, 'tv_series_id': 3, 'is_following': False}
+        ])
+
+        # tv_series has no refreshed_at yet: migration 5 adds it after this one runs
+        assert 'refreshed_at' not in [column['name'] for column in inspect(connection).get_columns('tv_series')]
+        migrations.create_watchlist_summaries(connection)
+
+        summaries = dict(connection.execute(select([
+            migrations.watchlist_summaries.c.user_id,
+            migrations.watchlist_summaries.c['items']
+        ])).fetchall())
+
+    assert [item['name'] for item in summaries[1]] == ['Better Call Saul', 'Breaking Bad']
+    assert summaries[2] == []
+
+
+def test_plan_checks_compile_for_postgres(db_session):
+
+    from sqlalchemy.dialects import postgresql
+    for name, query, expected_indexes in migrations.plan_checks(db_session):
+        assert str(query.statement.compile(dialect=postgresql.dialect())), name
+
+
+def follows_scan(node_type, index_name=None):
+
+    node = {'Node Type': node_type, 'Relation Name': 'users_following_tv_series'}
+    if index_name:
+        node['Index Name'] = index_name
+    return node
+
+
+def test_inactive_follow_reads_flags_scans_outside_the_partial_indexes():
+
+    def plan(*scans):
+        return [{'Plan': {'Node Type': 'Hash Anti Join', 'Plans': list(scans)}}]
+
+    bitmap_scan = follows_scan('Bitmap Heap Scan')
+    bitmap_scan['Plans'] = [{'Node Type': 'Bitmap Index Scan', 'Index Name': 'users_following_tv_series_pkey'}]
+
+    assert migrations.inactive_follow_reads(plan(
+        follows_scan('Index Only Scan', 'ix_follows_series_following'),
+        {'Node Type': 'Seq Scan', 'Relation Name': 'tv_series'}
+    )) == []
+    assert migrations.inactive_follow_reads(plan(follows_scan('Seq Scan'))) == ['Seq Scan (no index)']
+    assert migrations.inactive_follow_reads(plan(
+        follows_scan('Index Scan', 'users_following_tv_series_pkey')
+    )) == ['Index Scan (users_following_tv_series_pkey)']
+    assert migrations.inactive_follow_reads(plan(bitmap_scan)) == ['Bitmap Heap Scan (users_following_tv_series_pkey)']
@@ -0,0 +1,99 @@
+import time
+import threading
+import series_index
+from db_schema import Series_Catalog
+
+
+def catalog(*names):
+
+    return {
+        'last_page': 0,
+        'rows': [[i, name, '2008', 90, 1500000000] for i, name in enumerate(names, 1)]
+    }
+
+
+def reset_index(monkeypatch):
+
+    monkeypatch.setattr(series_index, '_index', None)
+    monkeypatch.setattr(series_index, '_catalog_id', None)
+    monkeypatch.setattr(series_index, '_checked_at', 0.0)
+    monkeypatch.setattr(series_index, '_loader_pid', None)
+
+
+def test_saving_a_catalog_replaces_the_previous_one(db_session):
+
+    first_id = series_index.save_catalog(db_session, catalog('Breaking Bad'))
+    second_id = series_index.save_catalog(db_session, catalog('Breaking Bad', 'Better Call Saul'))
+
+    assert db_session.query(Series_Catalog.id).all() == [(second_id,)]
+    loaded = series_index.load_catalog(db_session)
+    assert loaded['id'] == second_id and len(loaded['rows']) == 2
+    assert series_index.load_catalog(db_session, newer_than=second_id) is None
+    assert series_index.load_catalog(db_session, newer_than=first_id)['id'] == second_id
+
+
+def test_load_index_searches_the_stored_catalog(db_session, monkeypatch):
+
+    reset_index(monkeypatch)
+    series_index.save_catalog(db_session, catalog('Breaking Bad', 'Better Call Saul', 'The Wire'))
+
+    index = series_index.load_index()
+
+    assert [row[series_index.NAME] for row in index.search('breaki')] == ['Breaking Bad']
+
+
+def test_get_index_builds_a_new_index_off_the_calling_thread(db_session, monkeypatch):
+
+    reset_index(monkeypatch)
+    series_index.save_catalog(db_session, catalog('Breaking Bad'))
+    old_index = series_index.load_index()
+    series_index.save_catalog(db_session, catalog('Breaking Bad', 'Better Call Saul'))
+
+    building = threading.Event()
+    release = threading.Event()
+    build_index = series_index.SeriesIndex
+
+    def slow_index(rows):
+        building.set()
+        release.wait(5)
+        return build_index(rows)
+
+    monkeypatch.setattr(series_index, 'SeriesIndex', slow_index)
+    monkeypatch.setattr(series_index, '_checked_at', 0.0)
+
+    # Returns the current index straight away while the loader thread builds the new one
+    assert series_index.get_index() is old_index
+    assert building.wait(5)
+    assert series_index.get_index() is old_index
+
+    release.set()
+    deadline = time.time() + 5
+    while series_index.get_index() is old_index and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(series_index.get_index()) == 2
+
+
+def test_update_catalog_refetches_changed_pages_only(db_session, monkeypatch):
+
+    pages = {
+        0: [{'id': 1, 'name': 'Breaking Bad', 'premiered': '2008-01-20', 'weight': 99, 'updated': 100}],
+        1: [{'id': series_index.PAGE_SIZE + 1, 'name': 'The Wire', 'premiered': '2002-06-02', 'weight': 98, 'updated': 100}]
+    }
+    fetched = []
+
+    def fetch_catalog_page(page):
+        fetched.append(page)
+        return pages.get(page)
+
+    monkeypatch.setattr(series_index, 'fetch_catalog_page', fetch_catalog_page)
+    series_index.update_catalog(full_rebuild=True)
+    assert fetched == [0, 1, 2]
+
+    del fetched[:]
+    pages[0][0].update(name='Breaking Bad (US)', updated=200)
+    updated = series_index.update_catalog(show_updates={1: 200, series_index.PAGE_SIZE + 1: 100})
+
+    # Page 0 for the changed show, then the last known page onwards for new shows
+    assert fetched == [0, 1, 2]
+    assert [row[series_index.NAME] for row in updated['rows']] == ['Breaking Bad (US)', 'The Wire']
+    assert series_index.load_catalog(db_session)['id'] == updated['id']
@@ -0,0 +1,40 @@
+import json
+import requests
+import http_client
+import slack
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_post_response_is_sent_once_with_a_short_timeout(monkeypatch):
+
+    sent = []
+
+    def post(url, **kwargs):
+        sent.append((url, kwargs))
+        return FakeResponse(200)
+
+    monkeypatch.setattr(http_client, 'post', post)
+
+    assert slack.post_response('https://hooks.slack.com/actions/T1/1/abc', 'busy')
+
+    [(url, kwargs)] = sent
+    assert url == 'https://hooks.slack.com/actions/T1/1/abc'
+    assert kwargs['retries'] == 0 and kwargs['timeout'] == slack.RESPONSE_URL_TIMEOUT
+    assert json.loads(kwargs['data']) == {'response_type': 'ephemeral', 'replace_original': False, 'text': 'busy'}
+
+
+def test_post_response_failures_are_logged_not_raised(monkeypatch):
+
+    def post(url, **kwargs):
+        raise requests.Timeout('timed out')
+
+    monkeypatch.setattr(http_client, 'post', post)
+    assert not slack.post_response('https://hooks.slack.com/actions/T1/1/abc', 'busy')
+
+    monkeypatch.setattr(http_client, 'post', lambda url, **kwargs: FakeResponse(404))
+    assert not slack.post_response('https://hooks.slack.com/actions/T1/1/abc', 'busy')
@@ -0,0 +1,121 @@
+import json
+from datetime import datetime
+import tvmaze
+from cache import LRUCache, PrefixCache
+from db_schema import User, TV_Series, Follow
+
+
+def add_series(session, tvmaze_id, name):
+
+    tv_series = TV_Series(tvmaze_id=tvmaze_id, name=name, status='Running', refreshed_at=datetime.utcnow())
+    session.add(tv_series)
+    session.flush()
+
+    return tv_series
+
+
+def test_find_series_user_follow_returns_the_follow(db_session):
+
+    tv_series = add_series(db_session, 1, 'Breaking Bad')
+    user = User(slack_id='U1', slack_name='walter')
+    db_session.add(user)
+    db_session.flush()
+    db_session.add(Follow(user_id=user.id, tv_series_id=tv_series.id, is_following=True))
+    db_session.flush()
+
+    found_series, found_user, follow = tvmaze.find_series_user_follow(db_session, 1, 'U1')
+
+    assert (found_series.id, found_user.id) == (tv_series.id, user.id)
+    assert follow.is_following
+
+
+def test_find_series_user_follow_with_missing_rows(db_session):
+
+    add_series(db_session, 1, 'Breaking Bad')
+    db_session.add(User(slack_id='U1', slack_name='walter'))
+    db_session.flush()
+
+    tv_series, user, follow = tvmaze.find_series_user_follow(db_session, 1, 'U2')
+    assert tv_series.tvmaze_id == 1 and user is None and follow is None
+
+    tv_series, user, follow = tvmaze.find_series_user_follow(db_session, 2, 'U1')
+    assert tv_series is None and user.slack_id == 'U1' and follow is None
+
+    tv_series, user, follow = tvmaze.find_series_user_follow(db_session, 1, 'U1')
+    assert tv_series.tvmaze_id == 1 and user.slack_id == 'U1' and follow is None
+
+
+class FakeResponse(object):
+
+    def __init__(self, payload, status_code=200):
+        self.content = json.dumps(payload)
+        self.status_code = status_code
+
+
+def search_hit(series_id, name, score, premiered='2008-01-20'):
+    return {'score': score, 'show': {'id': series_id, 'name': name, 'premiered': premiered}}
+
+
+def test_refine_search_results_ranks_exact_and_leading_matches_first():
+
+    results = [
+        {'id': 1, 'name': 'The Bad Batch', 'score': 20},
+        {'id': 2, 'name': 'Breaking Bad', 'score': 10},
+        {'id': 3, 'name': 'Bad', 'score': 5},
+        {'id': 4, 'name': 'Badlands', 'score': 15},
+        {'id': 5, 'name': 'Good Omens', 'score': 30}
+    ]
+
+    refined = tvmaze.refine_search_results(results, 'bad')
+
+    assert [result['id'] for result in refined] == [3, 4, 1, 2]
+
+
+def test_search_for_series_reuses_a_complete_prefix(monkeypatch):
+
+    calls = []
+
+    def get(url, params=None, **kwargs):
+        calls.append(params['q'])
+        return FakeResponse([search_hit(169, 'Breaking Bad', 20), search_hit(2, 'Breakout Kings', 12)])
+
+    monkeypatch.setattr(tvmaze.http_client, 'get', get)
+    monkeypatch.setattr(tvmaze, 'search_cache', PrefixCache(tvmaze.refine_search_results, min_prefix=3))
+
+    tvmaze.search_for_series('Brea')
+    payload = tvmaze.search_for_series('Breaking')
+
+    assert calls == ['Brea']
+    assert [option['value'] for option in payload['options']] == ['169']
+    assert tvmaze.search_cache.stats()['saved_calls'] == 1
+
+
+def test_search_for_series_looks_up_queries_a_full_prefix_cannot_answer(monkeypatch):
+
+    calls = []
+
+    def get(url, params=None, **kwargs):
+        calls.append(params['q'])
+        # SEARCH_RESULT_LIMIT results means TVmaze may have left matches out
+        return FakeResponse([search_hit(i, 'Breaking {}'.format(i), 10) for i in range(tvmaze.SEARCH_RESULT_LIMIT)])
+
+    monkeypatch.setattr(tvmaze.http_client, 'get', get)
+    monkeypatch.setattr(tvmaze, 'search_cache', PrefixCache(tvmaze.refine_search_results, min_prefix=3))
+
+    tvmaze.search_for_series('Brea')
+    tvmaze.search_for_series('Breaking')
+
+    assert calls == ['Brea', 'Breaking']
+
+
+def test_get_series_data_via_id_can_skip_the_cache(monkeypatch):
+
+    responses = iter([FakeResponse({'id': 169, 'name': 'Breaking Bad'}), FakeResponse({'id': 169, 'name': 'Breaking Bad (US)'})])
+    monkeypatch.setattr(tvmaze.http_client, 'get', lambda url, **kwargs: next(responses))
+    monkeypatch.setattr(tvmaze, 'response_cache', LRUCache())
+
+    assert tvmaze.get_series_data_via_id(169)['name'] == 'Breaking Bad'
+    assert tvmaze.get_series_data_via_id(169)['name'] == 'Breaking Bad'
+    assert tvmaze.get_series_data_via_id(169, use_cache=False)['name'] == 'Breaking Bad (US)'
+    # ...and what it fetched replaces the cached copy
+    assert tvmaze.get_series_data_via_id(169)['name'] == 'Breaking Bad (US)'
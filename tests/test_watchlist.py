@@ -0,0 +1,48 @@
+from datetime import datetime
+import watchlist
+from db_schema import User, TV_Series, Watchlist_Summary
+
+
+def add_rows(session, *names):
+
+    user = User(slack_id='U1', slack_name='walter')
+    series = [TV_Series(tvmaze_id=100 + i, name=name, status='Running', refreshed_at=datetime.utcnow())
+              for i, name in enumerate(names)]
+    session.add_all([user] + series)
+    session.flush()
+
+    return user, series
+
+
+def summary_items(session, user):
+
+    return session.query(Watchlist_Summary.items).filter_by(user_id=user.id).scalar()
+
+
+def test_follow_series_builds_then_patches_the_summary(pg_session):
+
+    user, series = add_rows(pg_session, 'Zorro', 'Ärger', 'breaking bad', 'Breaking Bad')
+
+    for tv_series in series:
+        assert watchlist.follow_series(pg_session, user.id, tv_series)
+    assert not watchlist.follow_series(pg_session, user.id, series[0])
+
+    # Sorted by code point, as build_items() sorts them
+    assert [item['name'] for item in summary_items(pg_session, user)] == ['Breaking Bad', 'Zorro', 'breaking bad', 'Ärger']
+    assert summary_items(pg_session, user) == watchlist.build_items(pg_session, user.id)
+
+
+def test_unfollow_series_only_matches_an_active_follow(pg_session):
+
+    user, series = add_rows(pg_session, 'Breaking Bad', 'The Wire')
+    watchlist.follow_series(pg_session, user.id, series[0])
+    watchlist.follow_series(pg_session, user.id, series[1])
+
+    unfollowed = watchlist.unfollow_series(pg_session, 'U1', 100)
+    assert (unfollowed.user_id, unfollowed.tv_series_id, unfollowed.name) == (user.id, series[0].id, 'Breaking Bad')
+    assert watchlist.unfollow_series(pg_session, 'U1', 100) is None
+    assert watchlist.unfollow_series(pg_session, 'U2', 101) is None
+
+    assert summary_items(pg_session, user) == [{'id': series[1].id, 'name': 'The Wire', 'status': 'Running'}]
+    watchlist.unfollow_series(pg_session, 'U1', 101)
+    assert summary_items(pg_session, user) == []
@@ -1,8 +1,15 @@
-import json
 import requests
 import os
 import logging
+import threading
+import jobs
+import log_setup
+import json_codec
+import http_client
 from random import choice
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from db_schema import TVDB_Banner, create_db_session
 
 # setup logging
 logger = logging.getLogger('main.thetvdb')
@@ -12,18 +19,143 @@ headers = {
     'Content-Type': 'application/json',
     'Accept': 'application/json'
 }
-api_url = 'https://api.thetvdb.com'
+api_url = os.environ.get('TVDB_API_URL', 'https://api.thetvdb.com')
+banner_max_age = timedelta(days=int(os.environ.get('TVDB_BANNER_MAX_AGE_DAYS', 30)))
+_revalidating = set()
+_revalidating_lock = threading.Lock()
 
-# authenticate with TheTVDB
-login_endpoint = api_url + '/login'
-apikey = os.environ['TVDB_APIKEY']
-payload = json.dumps({
-    'apikey': apikey
-})
+# TheTVDB tokens are valid for 24 hours; renew them well before that
+token_lifetime = timedelta(hours=24)
+token_refresh_margin = timedelta(hours=1)
+_token = None
+_token_expires_at = None
+_token_lock = threading.Lock()
 
-response = requests.post(login_endpoint, data=payload, headers=headers)
-tvdb_token = response.json().get('token')
-headers['Authorization'] = 'Bearer {}'.format(tvdb_token)
+
+def get_auth_headers(force_login=False):
+    """
+    Request headers carrying a valid TheTVDB token.
+    The token is obtained on first use, renewed through /refresh_token as it nears
+    expiry and replaced with a fresh login if renewal fails or `force_login` is set.
+    """
+    global _token, _token_expires_at
+
+    with _token_lock:
+        now = datetime.utcnow()
+        if force_login or _token is None:
+            _token = login()
+            _token_expires_at = now + token_lifetime
+        elif now >= _token_expires_at - token_refresh_margin:
+            _token = refresh_token(_token) or login()
+            _token_expires_at = now + token_lifetime
+
+        auth_headers = dict(headers)
+        auth_headers['Authorization'] = 'Bearer {}'.format(_token)
+
+    return auth_headers
+
+
+def login():
+
+    logger.info('Logging in to TheTVDB')
+    payload = json_codec.dumps({
+        'apikey': os.environ['TVDB_APIKEY']
+    })
+    response = http_client.post(api_url + '/login', data=payload, headers=headers)
+    response.raise_for_status()
+
+    return json_codec.loads(response.content).get('token')
+
+
+def refresh_token(token):
+
+    logger.info('Refreshing the TheTVDB token')
+    refresh_headers = dict(headers)
+    refresh_headers['Authorization'] = 'Bearer {}'.format(token)
+    response = http_client.get(api_url + '/refresh_token', headers=refresh_headers)
+    if response.status_code != 200:
+        logger.warning('Token refresh failed with status code %s', response.status_code)
+        return None
+
+    return json_codec.loads(response.content).get('token')
+
+
+def api_get(endpoint, params=None):
+    """GET from TheTVDB, logging in again once if the token has been rejected"""
+
+    response = http_client.get(endpoint, params=params, headers=get_auth_headers())
+    if response.status_code == 401:
+        response = http_client.get(endpoint, params=params, headers=get_auth_headers(force_login=True))
+
+    return response
+
+
+def find_series_banner(tvmaze_id, tvdb_id, imdb_id):
+    """
+    Return the banner URL for a TVmaze series, or None if TheTVDB has none.
+    Known series are answered from the tvdb_banners table without calling TheTVDB;
+    mappings older than banner_max_age are revalidated as a background job.
+    """
+
+    session = create_db_session()
+    mapping = session.query(TVDB_Banner). \
+        filter_by(tvmaze_id=tvmaze_id). \
+        first()
+    if mapping:
+        banner_url = mapping.banner_url
+        refreshed_at = mapping.refreshed_at
+    session.close()
+
+    if not mapping:
+        logger.info("No stored banner for TVmaze series '%s'", tvmaze_id)
+        return refresh_series_banner(tvmaze_id, tvdb_id, imdb_id)
+
+    if datetime.utcnow() - refreshed_at > banner_max_age:
+        with _revalidating_lock:
+            already_running = tvmaze_id in _revalidating
+            _revalidating.add(tvmaze_id)
+        if not already_running and not jobs.background.submit(revalidate_series_banner, tvmaze_id, tvdb_id, imdb_id):
+            with _revalidating_lock:
+                _revalidating.discard(tvmaze_id)
+
+    return banner_url
+
+
+def revalidate_series_banner(tvmaze_id, tvdb_id, imdb_id):
+
+    try:
+        refresh_series_banner(tvmaze_id, tvdb_id, imdb_id)
+    finally:
+        with _revalidating_lock:
+            _revalidating.discard(tvmaze_id)
+
+
+def refresh_series_banner(tvmaze_id, tvdb_id, imdb_id):
+    """Look the banner up on TheTVDB and store the result for next time"""
+
+    try:
+        if not validate_series_id(tvdb_id):
+            tvdb_id = find_series_id_via_imdb(imdb_id)
+        banner_url = get_series_banner(tvdb_id)
+    except (requests.RequestException, TypeError, IndexError, ValueError) as e:
+        logger.error("Banner lookup failed for TVmaze series '%s': %s", tvmaze_id, e)
+        return None
+
+    session = create_db_session()
+    session.merge(TVDB_Banner(
+        tvmaze_id=tvmaze_id,
+        tvdb_id=tvdb_id,
+        banner_url=banner_url,
+        refreshed_at=datetime.utcnow()
+    ))
+    try:
+        session.commit()
+    except IntegrityError:
+        # Another worker stored the same series first
+        session.rollback()
+    session.close()
+
+    return banner_url
 
 
 def get_series_banner(series_id):
@@ -35,16 +167,16 @@ def get_series_banner(series_id):
     }
 
     logger.info("Sending request to TheTVDB")
-    response = requests.get(endpoint, params=params, headers=headers)
-    banners = response.json().get('data')
+    response = api_get(endpoint, params=params)
+    banners = json_codec.loads(response.content).get('data')
     logger.info("Received banner data from TheTVDB")
-    logger.debug("Banner data received:\n{}".format(banners))
+    logger.debug("Banner data received:\n%s", log_setup.truncate(banners))
 
     if banners:
         image_base_url = "https://www.thetvdb.com/banners/"
         image_url = find_best_image(banners, image_base_url)
     else:
-        logger.warn("No banner images found on TVDB for series ID '{}'")
+        logger.warning("No banner images found on TVDB for series ID '%s'", series_id)
         image_url = None
 
     return image_url
@@ -83,7 +215,7 @@ def find_best_image(images, image_base_url):
         image_url = highest_rating['image_url']
 
     logger.info('Found best-reviewed image')
-    logger.debug('Series image info:\n{}'.format(highest_rating))
+    logger.debug('Series image info:\n%s', log_setup.truncate(highest_rating))
 
     return image_url
 
@@ -96,14 +228,14 @@ def get_series_network(series_id):
     endpoint = '{}/series/{}'.format(api_url, series_id)
 
     try:
-        response = requests.get(endpoint, headers=headers)
+        response = api_get(endpoint)
     except AttributeError:
         series_id 
         network = get_series_network(imdb_id)
         return network
 
-    network = response.json().get('data').get('network')
-    logger.info("Series network from TVDB: '{}'".format(network))
+    network = json_codec.loads(response.content).get('data').get('network')
+    logger.info("Series network from TVDB: '%s'", network)
 
 
 def find_series_id_via_imdb(imdb_id):
@@ -113,8 +245,8 @@ def find_series_id_via_imdb(imdb_id):
         "imdbId": imdb_id
     }
 
-    response = requests.get(endpoint, headers=headers, params=params)
-    series_id = response.json().get("data")[0].get("id")
+    response = api_get(endpoint, params=params)
+    series_id = json_codec.loads(response.content).get("data")[0].get("id")
 
     return series_id
 
@@ -124,14 +256,14 @@ def validate_series_id(series_id):
     # This function tests the series_id
     # If this returns false, use find_series_id_via_imdb() to get a correct series_id
 
-    logger.info("Testing series_id '{}' from TVmaze".format(series_id))
+    logger.info("Testing series_id '%s' from TVmaze", series_id)
     endpoint = "{}/series/{}".format(api_url, series_id)
 
-    response = requests.get(endpoint, headers=headers)
+    response = api_get(endpoint)
     
-    if response.json().get("data"):
-        logger.info("series_id '{}' is valid".format(series_id))
+    if json_codec.loads(response.content).get("data"):
+        logger.info("series_id '%s' is valid", series_id)
         return True
     else:
-        logger.warn("series_id '{}' is invalid".format(series_id))
+        logger.warning("series_id '%s' is invalid", series_id)
         return False
\ No newline at end of file
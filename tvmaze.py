@@ -1,6 +1,17 @@
-import requests
+import os
+import re
 import logging
-from datetime import datetime
+import metrics
+import log_setup
+import json_codec
+import http_client
+from urllib.parse import urlsplit
+import watchlist
+from datetime import datetime, timedelta
+from sqlalchemy import and_
+from sqlalchemy.dialects.postgresql import insert
+from cache import LRUCache, PrefixCache
+from ratelimit import TokenBucket
 from db_schema import Base, User, TV_Series, Follow, create_db_session
 from slack import post_message
 
@@ -8,64 +19,153 @@ from slack import post_message
 logger = logging.getLogger('main.tvmaze')
 
 # Constants
-API_URL = 'https://api.tvmaze.com'
+API_URL = os.environ.get('TVMAZE_API_URL', 'https://api.tvmaze.com')
+API_HOST = urlsplit(API_URL).netloc
+# Interactive lookups retry once; the daily batch jobs can afford to wait longer
+INTERACTIVE_RETRIES = 1
+BATCH_RETRIES = int(os.environ.get('TVMAZE_MAX_RETRIES', 5))
+
+# TVmaze allows at least 20 calls every 10 seconds per IP address
+rate_limiter = TokenBucket(
+    rate=float(os.environ.get('TVMAZE_RATE_LIMIT', 2)),
+    capacity=int(os.environ.get('TVMAZE_RATE_BURST', 10))
+)
+# Per-endpoint cache lifetimes, in seconds
+CACHE_TTLS = {
+    'series': int(os.environ.get('TVMAZE_SERIES_TTL', 3600)),
+    'episode': int(os.environ.get('TVMAZE_EPISODE_TTL', 3600)),
+    'search': int(os.environ.get('TVMAZE_SEARCH_TTL', 600))
+}
+response_cache = LRUCache(
+    max_entries=int(os.environ.get('TVMAZE_CACHE_ENTRIES', 2000)),
+    max_bytes=int(os.environ.get('TVMAZE_CACHE_BYTES', 32 * 1024 * 1024))
+)
+# /search/shows returns at most this many results; fewer means the set is complete
+SEARCH_RESULT_LIMIT = 10
+SEARCH_MIN_SCORE = 3
+# How long a tv_series row is trusted before following the show re-checks it with TVmaze
+SERIES_FRESHNESS = timedelta(hours=float(os.environ.get('SERIES_FRESHNESS_HOURS', 24)))
+
+
+def normalize_query(text):
+
+    return ' '.join(re.sub(r'[^\w]+', ' ', text.lower()).split())
+
+
+def refine_search_results(results, query):
+    """
+    Narrow a prefix's search results to a longer query: every query word must
+    start one of the name's words. Exact and leading matches rank first, then
+    TVmaze's score for the prefix.
+    """
 
+    query_words = query.split()
+    refined = []
+    for result in results:
+        name = normalize_query(result['name'])
+        name_words = name.split()
+        if not all(any(word.startswith(q) for word in name_words) for q in query_words):
+            continue
+        rank = 0 if name == query else 1 if name.startswith(query) else 2
+        refined.append((rank, -result['score'], result))
+
+    refined.sort(key=lambda item: (item[0], item[1]))
+    return [result for rank, score, result in refined]
+
+
+def search_options(results):
+    """Slack external_select payload for TVmaze search results, leaving out weak matches"""
 
-def search_for_series(text):
-    series_search_url = API_URL + '/search/shows?q=' + text
     payload = {
         'options': []
     }
+    for result in results:
+        if result['score'] < SEARCH_MIN_SCORE:
+            continue
+        series_year = ' (' + result['premiered'][0:4] + ')' if result['premiered'] else ''
+        payload['options'].append({
+            'text': {
+                'type': 'plain_text',
+                'text': result['name'] + series_year
+            },
+            'value': str(result['id'])
+        })
+
+    return payload
 
-    logger.info('Starting dynamic search for \'' + text + '\'')
 
-    search_results = requests.get(series_search_url)
+def search_for_series(text):
+
+    query = normalize_query(text)
+    cached_results = search_cache.get(query)
+    if cached_results is not None:
+        return search_options(cached_results)
+
+    logger.info("Starting dynamic search for '%s'", text)
+
+    search_results = http_client.get(API_URL + '/search/shows', params={'q': text}, retries=INTERACTIVE_RETRIES)
     status_code = search_results.status_code
 
     if status_code == 429:
         return ("The servers are busy. Try again in a few seconds.")
 
+    # Keep just what the options need, so more queries fit in the cache
+    results = [
+        {
+            'id': result['show']['id'],
+            'name': result['show'].get('name') or '',
+            'premiered': result['show'].get('premiered'),
+            'score': result.get('score') or 0
+        }
+        for result in json_codec.loads(search_results.content)
+    ]
+    search_cache.set(query, results, len(results) < SEARCH_RESULT_LIMIT, CACHE_TTLS['search'])
+
     logger.info('Filtering out weak matches...')
-    series_list = search_results.json()
-    for series in series_list:
-        if series.get('score') >= 3:
-            series_name = series.get('show').get('name')
-            series_id = str(series.get('show').get('id'))
-            try:
-                series_year = ' (' + series.get('show').get('premiered')[0:4] + ')'
-            except:
-                series_year = ''
-            
-            series_output = series_name + series_year
-            option = {
-                'text': {
-                    'type': 'plain_text',
-                    'text': series_output
-                },
-                'value': series_id
-            }
-            payload['options'].append(option)
+    payload = search_options(results)
 
     logger.info('Lookahead payload is complete')
-    logger.debug('Payload contents:\n{}'.format(payload))
+    logger.debug('Payload contents:\n%s', log_setup.truncate(payload))
 
     return payload
 
 
-def get_series_data_via_id(series_id):
-    logger.info("Looking up series_id '{}'".format(series_id))
+search_cache = PrefixCache(
+    refine_search_results,
+    max_entries=int(os.environ.get('TVMAZE_SEARCH_CACHE_ENTRIES', 5000)),
+    min_prefix=3  # the search box's min_query_length
+)
+
+
+def get_series_data_via_id(series_id, embed=(), use_cache=True):
+    """
+    Look up a series by TVmaze id.
+    `embed` names related resources (e.g. 'nextepisode') to return under '_embedded'
+    in the same response. With `use_cache` False the response cache is skipped
+    (though still updated), for callers that need the data as of now.
+    """
+    logger.info("Looking up series_id '%s'", series_id)
+    cache_key = ('series', str(series_id)) + tuple(embed)
+    cached_data = response_cache.get(cache_key) if use_cache else None
+    if cached_data is not None:
+        return cached_data
+
     series_lookup_url = API_URL + '/shows/{}'.format(series_id)
+    params = {'embed[]': list(embed)} if embed else None
 
-    series_data = requests.get(series_lookup_url)
+    series_data = http_client.get(series_lookup_url, params=params, retries=INTERACTIVE_RETRIES)
     status_code = series_data.status_code
 
     if status_code == 429:
         return ("The servers are busy. Try again in a few seconds.")
     
-    logger.info("Found TV series for series_id '{}'".format(series_id))
-    logger.debug("Series data:\n{}".format(series_data.json()))
+    logger.info("Found TV series for series_id '%s'", series_id)
+    data = json_codec.loads(series_data.content)
+    logger.debug("Series data:\n%s", log_setup.truncate(data))
+    if status_code == 200:
+        response_cache.set(cache_key, data, CACHE_TTLS['series'], size=len(series_data.content))
 
-    return series_data.json()
+    return data
 
 
 def get_series_data(series_name):
@@ -79,7 +179,7 @@ def get_series_data(series_name):
     series_search_url = API_URL + '/singlesearch/shows?q=' + series_name
 
     logger.info("Beginning a new search for '<%s>'", series_name)
-    series_data = requests.get(series_search_url)
+    series_data = http_client.get(series_search_url, retries=INTERACTIVE_RETRIES)
     status_code = series_data.status_code
 
     if status_code == 404:
@@ -87,108 +187,228 @@ def get_series_data(series_name):
     elif status_code == 429:
         return "The servers are busy. Try again in a few seconds."
     
-    logger.info("Found series data for {}".format(series_name))
+    logger.info("Found series data for %s", series_name)
 
-    return series_data.json()
+    return json_codec.loads(series_data.content)
 
 
 def get_episode_data(episode_url):
 
-    logger.info("Requesting episode found at " + episode_url)
-    episode_data = requests.get(episode_url)
+    cache_key = ('episode', episode_url)
+    cached_data = response_cache.get(cache_key)
+    if cached_data is not None:
+        return cached_data
+
+    logger.info("Requesting episode found at %s", episode_url)
+    episode_data = http_client.get(episode_url, retries=INTERACTIVE_RETRIES)
 
     logger.info("Found episode.")
-    logger.debug("Episode data:\n{}".format(episode_data.json()))
+    data = json_codec.loads(episode_data.content)
+    logger.debug("Episode data:\n%s", log_setup.truncate(data))
+    if episode_data.status_code == 200:
+        response_cache.set(cache_key, data, CACHE_TTLS['episode'], size=len(episode_data.content))
 
-    return episode_data.json()
+    return data
 
 
-def add_series_to_watchlist(series_id, user_id, user_name):
-    series_data = get_series_data_via_id(series_id)
-    series_name = series_data['name']
+def invalidate_series(series_id, embed=()):
+    """Drop a series from the response cache, e.g. after it is known to have changed"""
 
-    # Pass along message to user if response isn't a dictionary (i.e. doesn't contain data)
-    # This is usually the result of a 404 status code when searching for a TV series match
-    if type(series_data) != dict:
-        return series_data
+    response_cache.invalidate(('series', str(series_id)) + tuple(embed))
 
-    session = create_db_session()
 
-    logger.info("Checking to see if TV Series and User already exist in the database...")
-    tv_series = session.query(TV_Series). \
-        filter_by(tvmaze_id=series_id). \
+def fetch_with_backoff(url, params=None):
+    """
+    GET a TVmaze URL for the batch jobs: paced by the shared rate limiter, which
+    a 429 pauses for the server's Retry-After before the request is retried.
+    """
+
+    return http_client.get(url, params=params, retries=BATCH_RETRIES, rate_limiter=rate_limiter)
+
+
+def get_series_with_next_episode(series_id):
+    """
+    Fetch a series with its next episode embedded, so one request covers both.
+    Returns None when TVmaze doesn't have the series (or keeps refusing us).
+    """
+
+    series_lookup_url = API_URL + '/shows/{}'.format(series_id)
+    response = fetch_with_backoff(series_lookup_url, params={'embed': 'nextepisode'})
+
+    if response.status_code != 200:
+        logger.warning("Could not refresh series_id '%s'. Status code: %s", series_id, response.status_code)
+        return None
+
+    return json_codec.loads(response.content)
+
+
+def get_show_updates():
+    """
+    Download TVmaze's update index: {tvmaze_id: last-modified timestamp} for every show.
+    Returns None if the index couldn't be fetched.
+    """
+
+    logger.info('Downloading the TVmaze show update index')
+    response = fetch_with_backoff(API_URL + '/updates/shows')
+
+    if response.status_code != 200:
+        logger.warning('Could not download the show update index. Status code: %s', response.status_code)
+        return None
+
+    return {int(series_id): timestamp for series_id, timestamp in json_codec.loads(response.content).items()}
+
+
+def parse_next_episode(series_data):
+    """Pull the next-episode columns out of a series payload fetched with embed=nextepisode"""
+
+    episode_data = series_data.get('_embedded', {}).get('nextepisode')
+    if not episode_data:
+        return {
+            'next_episode_season': None,
+            'next_episode_number': None,
+            'next_episode_name': None,
+            'next_episode_date': None,
+            'next_episode_api_url': None
+        }
+
+    airdate = episode_data.get('airdate')
+    return {
+        'next_episode_season': episode_data.get('season'),
+        'next_episode_number': episode_data.get('number'),
+        'next_episode_name': episode_data.get('name'),
+        'next_episode_date': datetime.strptime(airdate, '%Y-%m-%d') if airdate else None,
+        'next_episode_api_url': episode_data['_links']['self']['href']
+    }
+
+
+def apply_series_data(tv_series, series_data):
+    """
+    Copy a series payload fetched with embed=nextepisode onto its TV_Series row.
+    Returns True if the name or status changed (so watchlist summaries need patching).
+    """
+
+    changed = tv_series.name != series_data.get('name') or tv_series.status != series_data.get('status')
+    for column, value in series_columns(series_data).items():
+        setattr(tv_series, column, value)
+
+    return changed
+
+
+def is_fresh(tv_series):
+
+    return tv_series.refreshed_at is not None and datetime.utcnow() - tv_series.refreshed_at < SERIES_FRESHNESS
+
+
+def find_series_user_follow(session, series_id, slack_id):
+    """The series, the user and their follow row, in one query. Any of them may be None."""
+
+    row = session.query(TV_Series, User, Follow). \
+        select_from(TV_Series). \
+        outerjoin(User, User.slack_id == slack_id). \
+        outerjoin(Follow, and_(Follow.tv_series_id == TV_Series.id, Follow.user_id == User.id)). \
+        filter(TV_Series.tvmaze_id == series_id). \
         first()
+    if row is not None:
+        return row
+
     user = session.query(User). \
-        filter_by(slack_id=user_id). \
+        filter_by(slack_id=slack_id). \
         first()
 
-    if not tv_series:
-        logger.info("TV Series '" + series_name + "' with "
-            "ID '" + str(series_id) + "' did not exist in database. Creating"
-            " an entry now.")
-        
-        try:
-            next_episode_api_url = series_data['_links']['nextepisode']['href']
-        except KeyError:
-            next_episode_api_url = None
-            next_episode_season = None
-            next_episode_number = None
-            next_episode_name = None
-            next_episode_date = None
-
-        if next_episode_api_url:
-            episode_data = requests.get(next_episode_api_url).json()
-            next_episode_season = episode_data.get('season')
-            next_episode_number = episode_data.get('number')
-            next_episode_name = episode_data.get('name')
-            next_episode_date = datetime.strptime(episode_data.get('airdate'), '%Y-%m-%d')
-
-        tv_series = TV_Series(
-            tvmaze_id=series_id,
-            name=series_name,
-            status=series_data.get('status'),
-            api_url=series_data['_links'].get('self')['href'],
-            next_episode_season=next_episode_season,
-            next_episode_number=next_episode_number,
-            next_episode_name=next_episode_name,
-            next_episode_date=next_episode_date,
-            next_episode_api_url=next_episode_api_url
-        )
-        session.add(tv_series)
-
-    if not user:
-        logger.info("User '" + str(user_id) + "' did not exist in database. Creating an entry now.")
-        user = User(
-            slack_id=user_id,
-            slack_name=user_name)
-        session.add(user)
-
-    follow_status = session.query(Follow). \
-        filter_by(tv_series_id=tv_series.id). \
-        filter_by(user_id=user.id). \
-        first()
+    return None, user, None
 
-    if not follow_status:
-        logger.info("User '" + str(user.slack_id) + "' and TV Series '" + \
-              tv_series.name + "' did not have a joint table entry. Creating an entry now.")
-        follow_status = Follow(
-            tv_series_id=tv_series.id,
-            user_id=user.id,
-            is_following=True)
-        session.add(follow_status)
-        output_text = "_You are now following " + tv_series.name + " and " + \
-                      "will receive notification before a new episode airs._"
 
-    elif follow_status.is_following:
-        output_text = "_You are already following " + tv_series.name + "._"
+def series_columns(series_data):
+    """TV_Series column values from a series payload fetched with embed=nextepisode"""
+
+    columns = {
+        'name': series_data.get('name'),
+        'status': series_data.get('status'),
+        'api_url': series_data['_links']['self']['href'],
+        'updated': series_data.get('updated'),
+        'refreshed_at': datetime.utcnow()
+    }
+    columns.update(parse_next_episode(series_data))
+
+    return columns
+
+
+def upsert_series(session, series_id, series_data):
+    """Insert or refresh a series row. Returns its (id, name, status)."""
+
+    columns = series_columns(series_data)
+    statement = insert(TV_Series.__table__).values(tvmaze_id=series_id, **columns)
+    statement = statement.on_conflict_do_update(
+        index_elements=[TV_Series.__table__.c.tvmaze_id],
+        set_=columns
+    ).returning(TV_Series.__table__.c.id, TV_Series.__table__.c.name, TV_Series.__table__.c.status)
+
+    return session.execute(statement).first()
+
+
+def upsert_user(session, slack_id, slack_name):
+    """Insert a user, or pick up their current Slack name. Returns their id."""
+
+    statement = insert(User.__table__).values(slack_id=slack_id, slack_name=slack_name)
+    statement = statement.on_conflict_do_update(
+        index_elements=[User.__table__.c.slack_id],
+        set_={'slack_name': statement.excluded.slack_name}
+    ).returning(User.__table__.c.id)
+
+    return session.execute(statement).scalar()
+
+
+def add_series_to_watchlist(series_id, user_id, user_name):
+    """
+    Follow a series for a Slack user.
+    TVmaze is only asked about series we don't have yet, or whose row is older than
+    SERIES_FRESHNESS. The user, series and follow rows are written with
+    INSERT ... ON CONFLICT in one transaction, so concurrent clicks can't collide
+    on the unique keys.
+    Following a known, fresh series takes three round trips: the lookup, one
+    statement for the follow and its summary, and the commit. The lookup stays
+    separate because it decides whether TVmaze has to be asked first.
+    """
+
+    session = create_db_session()
+
+    logger.info("Checking to see if TV Series and User already exist in the database...")
+    tv_series, user, follow_status = find_series_user_follow(session, series_id, user_id)
 
+    if follow_status and follow_status.is_following:
+        session.close()
+        return "_You are already following " + tv_series.name + "._"
+
+    if not tv_series or not is_fresh(tv_series):
+        # Straight from TVmaze: the row is stamped refreshed_at now, which a cached
+        # response (up to TVMAZE_SERIES_TTL old) would overstate
+        series_data = get_series_data_via_id(series_id, embed=('nextepisode',), use_cache=False)
+
+        # Pass along message to user if response isn't a dictionary (i.e. doesn't contain data)
+        # This is usually the result of a 404 status code when searching for a TV series match
+        if type(series_data) != dict:
+            session.close()
+            return series_data
+
+        if not tv_series:
+            logger.info("TV Series '%s' with ID '%s' did not exist in database. Creating an entry now.",
+                        series_data['name'], series_id)
+            tv_series = upsert_series(session, series_id, series_data)
+        elif apply_series_data(tv_series, series_data):
+            watchlist.update_series_in_summaries(session, [tv_series])
+
+    if user:
+        user_pk = user.id
     else:
-        session.query(Follow). \
-            filter_by(tv_series_id=follow_status.tv_series_id). \
-            filter_by(user_id=follow_status.user_id). \
-            update({'is_following': True})
+        logger.info("User '%s' did not exist in database. Creating an entry now.", user_id)
+        user_pk = upsert_user(session, user_id, user_name)
+
+    if watchlist.follow_series(session, user_pk, tv_series):
         output_text = "_You are now following " + tv_series.name + " and " + \
                       "will receive notification before a new episode airs._"
+    else:
+        # A concurrent click got there first
+        output_text = "_You are already following " + tv_series.name + "._"
 
     session.commit()
     session.close()
@@ -198,46 +418,23 @@ def add_series_to_watchlist(series_id, user_id, user_name):
 
 def remove_series_from_watchlist(series_id, user_id):
     """
-    * lookup TV series (get ID)
-    * match ID against tvmaze_id in database
-    * query the relationship between tv_series_id and user_id
-    * if is_following is already false, tell user
-    * otherwise, set is_following to false and notify user
+    Unfollow a series with a single statement, which only matches an active
+    follow and patches the watchlist summary if it did.
     """
 
     session = create_db_session()
 
-    tv_series = session.query(TV_Series). \
-        filter_by(tvmaze_id=series_id). \
-        first()
-
-    if not tv_series:
-        session.close()
-        output_text = "_Congratulations! You're already *not* following " + series_name + "._"
-        return output_text
-
-    user = session.query(User). \
-        filter_by(slack_id=user_id). \
-        first()
-
-    follow_status = session.query(Follow). \
-        filter_by(tv_series_id=tv_series.id). \
-        filter_by(user_id=user.id). \
-        first()
+    unfollowed = watchlist.unfollow_series(session, user_id, series_id)
 
-    if not follow_status or follow_status.is_following == False:
-        response_string = "_Congratulations! You're already *not* following " + \
-                          tv_series.name + "._"
+    if not unfollowed:
+        series_name = session.query(TV_Series.name). \
+            filter_by(tvmaze_id=series_id). \
+            scalar()
         session.close()
-        return response_string
-    else:
-        session.query(Follow). \
-            filter_by(tv_series_id=follow_status.tv_series_id). \
-            filter_by(user_id=follow_status.user_id). \
-            update({'is_following': False})
+        return "_Congratulations! You're already *not* following " + (series_name or "that show") + "._"
 
     response_string = "_You will no longer receive notifications for " + \
-                       tv_series.name + " and are entitled to all the benefits " + \
+                       unfollowed.name + " and are entitled to all the benefits " + \
                       "(or lack) thereof._"
 
     session.commit()
@@ -246,11 +443,10 @@ def remove_series_from_watchlist(series_id, user_id):
     return response_string
 
 
+@metrics.timed('render', block='watchlist')
 def create_watchlist_output(slack_id, slack_name, channel_id):
     """
-    get user id (primary key)
-    look up user in Follow table, return all tv_series_ids they follow
-    look up names of tv_series_id
+    read the user's precomputed watchlist summary (see watchlist.py)
     return string with list of TV shows
     """
     def send_empty_watchlist_notification():
@@ -266,49 +462,23 @@ def create_watchlist_output(slack_id, slack_name, channel_id):
         ]
         post_message(blocks, slack_id=slack_id, channel_id=channel_id, ephemeral=True)
 
-    session = create_db_session()
-
-    logger.info("Looking for user in database")
-    user = session.query(User). \
-        filter_by(slack_id=slack_id). \
-        first()
-    if not user:
-        send_empty_watchlist_notification()
-        return None
-
-    logger.info("Querying the user's watchlist")
-    followed_series_ids = session.query(Follow.tv_series_id). \
-        filter_by(user_id=user.id). \
-        filter_by(is_following=True). \
-        all()
-    if len(followed_series_ids) == 0:
+    logger.info("Reading the user's watchlist summary")
+    sorted_watchlist = watchlist.get_watchlist(slack_id)
+    if not sorted_watchlist:
         send_empty_watchlist_notification()
         return None
 
-    watchlist_data = []
-    for series_id in followed_series_ids:
-        series_data = session.query(TV_Series).filter_by(id=series_id).scalar()
-        watchlist_item = {
-            'name': series_data.name,
-            'status': series_data.status,
-            'next_episode_date': series_data.next_episode_date
-        }
-        watchlist_data.append(watchlist_item)
-
-    sorted_watchlist = sorted(watchlist_data, key=lambda k: k['name'])
     output_string = "*WATCHLIST REPORT FOR {}:*\n".format(slack_name.upper())
     for series in sorted_watchlist:
         output_string += '\n*{}* | _status: {}_'.format(series['name'], series['status'].lower())
         if series['status'] == 'Ended':
             output_string += ' :x:'
 
-    session.close()
-
     payload = {
         "text": output_string
     }
 
-    logger.info(payload)
+    logger.debug('Watchlist payload:\n%s', log_setup.truncate(payload))
     
     return payload
 
@@ -317,8 +487,8 @@ def get_episodes_for_date(date):
 
     episodes_airing_today_url = API_URL + '/schedule?country=US&date='
 
-    response = requests.get(episodes_airing_today_url + date)
-    episodes_for_date = response.json()
+    response = http_client.get(episodes_airing_today_url + date, retries=INTERACTIVE_RETRIES)
+    episodes_for_date = json_codec.loads(response.content)
 
     return episodes_for_date
 
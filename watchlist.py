@@ -0,0 +1,194 @@
+"""
+Each user's followed series are kept precomputed in watchlist_summaries, sorted by name,
+so /watchlist is a single indexed read. Every change to a follow or to a followed
+series' name/status has to go through the functions below, inside the same
+transaction as the change itself.
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import text
+from db_schema import User, TV_Series, Follow, Watchlist_Summary, create_db_session
+
+# setup logging
+logger = logging.getLogger('main.watchlist')
+
+# Following and unfollowing change the follow row and patch the summary in one
+# statement. Both CTEs run on the same snapshot, so the summary is only patched when
+# the follow change returned a row. Names sort with COLLATE "C", i.e. by code point,
+# like Python's sorted() in the functions below.
+FOLLOW_STATEMENT = text("""
+WITH followed AS (
+    INSERT INTO users_following_tv_series (user_id, tv_series_id, is_following)
+    VALUES (:user_id, :tv_series_id, true)
+    ON CONFLICT (user_id, tv_series_id) DO UPDATE SET is_following = true
+    WHERE users_following_tv_series.is_following IS DISTINCT FROM true
+    RETURNING user_id
+), summarized AS (
+    UPDATE watchlist_summaries SET
+        items = (
+            SELECT json_agg(item ORDER BY item->>'name' COLLATE "C")
+            FROM (
+                SELECT item FROM json_array_elements(watchlist_summaries.items) AS item
+                WHERE (item->>'id')::int <> :tv_series_id
+                UNION ALL
+                SELECT json_build_object('id', :tv_series_id, 'name', CAST(:name AS text), 'status', CAST(:status AS text))
+            ) AS patched
+        ),
+        updated_at = :now
+    WHERE user_id IN (SELECT user_id FROM followed)
+    RETURNING user_id
+)
+SELECT (SELECT count(*) FROM followed) AS followed, (SELECT count(*) FROM summarized) AS summarized
+""")
+UNFOLLOW_STATEMENT = text("""
+WITH unfollowed AS (
+    UPDATE users_following_tv_series SET is_following = false
+    FROM users, tv_series
+    WHERE users_following_tv_series.user_id = users.id AND users.slack_id = :slack_id
+      AND users_following_tv_series.tv_series_id = tv_series.id AND tv_series.tvmaze_id = :tvmaze_id
+      AND users_following_tv_series.is_following
+    RETURNING users_following_tv_series.user_id, users_following_tv_series.tv_series_id, tv_series.name
+), summarized AS (
+    UPDATE watchlist_summaries SET
+        items = (
+            SELECT coalesce(json_agg(item ORDER BY position), '[]')
+            FROM json_array_elements(watchlist_summaries.items) WITH ORDINALITY AS kept (item, position)
+            WHERE (item->>'id')::int <> unfollowed.tv_series_id
+        ),
+        updated_at = :now
+    FROM unfollowed
+    WHERE watchlist_summaries.user_id = unfollowed.user_id
+    RETURNING watchlist_summaries.user_id
+)
+SELECT user_id, tv_series_id, name, (SELECT count(*) FROM summarized) AS summarized FROM unfollowed
+""")
+
+
+def summary_item(tv_series):
+
+    return {
+        'id': tv_series.id,
+        'name': tv_series.name,
+        'status': tv_series.status
+    }
+
+
+def get_watchlist(slack_id):
+    """Return the summary items for a Slack user, or None if they follow nothing"""
+
+    session = create_db_session()
+    items = summary_query(session, slack_id).scalar()
+    session.close()
+
+    return items or None
+
+
+def summary_query(session, slack_id):
+    """The /watchlist read, also EXPLAINed by `migrations.py check-plans`"""
+
+    return session.query(Watchlist_Summary.items). \
+        join(User, User.id == Watchlist_Summary.user_id). \
+        filter(User.slack_id == slack_id)
+
+
+def build_items(session, user_id):
+
+    # Just the columns a summary item needs, not whole TV_Series rows
+    followed_series = session.query(TV_Series.id, TV_Series.name, TV_Series.status). \
+        join(Follow, Follow.tv_series_id == TV_Series.id). \
+        filter(Follow.user_id == user_id). \
+        filter(Follow.is_following == True). \
+        all()
+
+    return sorted((summary_item(s) for s in followed_series), key=lambda item: item['name'])
+
+
+def lock_summary(session, user_id):
+    """Return the user's summary row, locked for this transaction, creating it if missing"""
+
+    summary = session.query(Watchlist_Summary). \
+        filter_by(user_id=user_id). \
+        with_for_update(). \
+        first()
+    if summary is None:
+        summary = Watchlist_Summary(user_id=user_id, items=build_items(session, user_id), updated_at=datetime.utcnow())
+        session.add(summary)
+
+    return summary
+
+
+def follow_series(session, user_id, tv_series):
+    """
+    Make a follow active and add the series to the user's summary, in one statement.
+    Returns True if the follow changed (False if it was already active).
+    """
+
+    # The statement bypasses the ORM, so it has to see any pending changes
+    session.flush()
+    row = session.execute(FOLLOW_STATEMENT, {
+        'user_id': user_id,
+        'tv_series_id': tv_series.id,
+        'name': tv_series.name,
+        'status': tv_series.status,
+        'now': datetime.utcnow()
+    }).first()
+    if row.followed and not row.summarized:
+        # A first follow: the user has no summary row to patch yet, so build it
+        lock_summary(session, user_id)
+
+    return bool(row.followed)
+
+
+def unfollow_series(session, slack_id, tvmaze_id):
+    """
+    End a Slack user's active follow of a series (by TVmaze id) and drop it from
+    their summary, in one statement. Returns the follow's row (user_id,
+    tv_series_id, name), or None if there was no active follow.
+    """
+
+    session.flush()
+    row = session.execute(UNFOLLOW_STATEMENT, {
+        'slack_id': slack_id,
+        'tvmaze_id': int(tvmaze_id),
+        'now': datetime.utcnow()
+    }).first()
+    if row is None:
+        return None
+    if not row.summarized:
+        lock_summary(session, row.user_id)
+
+    return row
+
+
+def refresh_summary(session, user_id):
+    """Recompute one user's summary from the follows table, e.g. after a bulk import"""
+
+    summary = lock_summary(session, user_id)
+    summary.items = build_items(session, user_id)
+    summary.updated_at = datetime.utcnow()
+
+
+def update_series_in_summaries(session, changed_series):
+    """Patch the name/status of `changed_series` (TV_Series rows) in their followers' summaries"""
+
+    if not changed_series:
+        return 0
+
+    changed = {s.id: summary_item(s) for s in changed_series}
+    followers = session.query(Follow.user_id). \
+        filter(Follow.tv_series_id.in_(list(changed))). \
+        filter(Follow.is_following == True). \
+        subquery()
+    summaries = session.query(Watchlist_Summary). \
+        filter(Watchlist_Summary.user_id.in_(followers)). \
+        with_for_update(). \
+        all()
+
+    for summary in summaries:
+        items = [changed.get(item['id'], item) for item in summary.items]
+        summary.items = sorted(items, key=lambda item: item['name'])
+        summary.updated_at = datetime.utcnow()
+
+    logger.info('Updated %d watchlist summaries for %d changed series', len(summaries), len(changed))
+
+    return len(summaries)